@@ -1,15 +1,27 @@
 # 1. Import Statements
-from flask import Flask, request, jsonify, render_template, session, make_response
-import firebase_admin
-from firebase_admin import credentials, firestore
+from flask import Flask, request, jsonify, render_template, session, Response, stream_with_context, url_for, g, has_request_context, send_from_directory
+import base64
+import gzip
+import hashlib
+import io
+import ipaddress
 import json
 import requests
-import openai
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type  # Updated import
+from tenacity import Retrying, stop_after_attempt, wait_exponential, retry_if_exception
+from requests.adapters import HTTPAdapter
 import os
+import queue
 import logging
+import math
+import re
 import threading
+import time
+import uuid
 from cachetools import TTLCache
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed
+from datetime import datetime, timezone
 
 # 2. Configuration and Setup
 app = Flask(__name__)
@@ -17,99 +29,789 @@ app = Flask(__name__)
 # Enable session management
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'your_secret_key')  # Replace 'your_secret_key' with an actual key for production
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
 logger = logging.getLogger(__name__)
 
-# Firebase Initialization
+# Firebase Initialization. firebase_admin and the Firestore gRPC client are only imported and
+# built on first use (get_db), so cold starts that never touch Firestore skip that cost.
 def initialize_firebase():
+    import firebase_admin
+    from firebase_admin import credentials, firestore
     if not firebase_admin._apps:
         cred = credentials.Certificate(json.loads(os.environ.get('FIREBASE_CREDENTIALS')))
         firebase_admin.initialize_app(cred)
     return firestore.client()
 
-db = initialize_firebase()
+# Same value as firestore.Query.DESCENDING, without importing firestore
+FIRESTORE_DESCENDING = 'DESCENDING'
+
+def server_timestamp():
+    from firebase_admin import firestore
+    return firestore.SERVER_TIMESTAMP
+
+firestore_client = {'db': None}
+firestore_client_lock = threading.Lock()
+
+def get_db():
+    if firestore_client['db'] is None:
+        with firestore_client_lock:
+            if firestore_client['db'] is None:
+                firestore_client['db'] = initialize_firebase()
+    return firestore_client['db']
+
+# Cache backend. Every TieredCache reads through an in-process LRU/TTL tier, then an optional
+# shared Redis-compatible tier (CACHE_REDIS_URL) so hot data survives serverless instance
+# churn, then an optional read-only JSON snapshot (CACHE_SNAPSHOT_DIR/<namespace>.json)
+# shipped with the deployment.
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
+CACHE_KEY_PREFIX = os.environ.get('CACHE_KEY_PREFIX', 'memegen:')
+CACHE_SNAPSHOT_DIR = os.environ.get('CACHE_SNAPSHOT_DIR')
+CACHE_SHARED_RETRY = float(os.environ.get('CACHE_SHARED_RETRY', 30))
+shared_cache = {'client': None, 'loaded': False, 'failed_at': None}
+shared_cache_lock = threading.Lock()
+
+def get_shared_cache_client():
+    """
+    Returns the shared tier's client: anything with Redis' get/set(ex=)/delete
+    methods. Tests and local runs can put a stand-in in shared_cache['client'].
+    """
+    with shared_cache_lock:
+        if not shared_cache['loaded']:
+            shared_cache['loaded'] = True
+            if CACHE_REDIS_URL and shared_cache['client'] is None:
+                try:
+                    import redis
+                    shared_cache['client'] = redis.Redis.from_url(CACHE_REDIS_URL, socket_timeout=0.25, socket_connect_timeout=0.25)
+                except ImportError:
+                    logger.warning("CACHE_REDIS_URL is set but the redis package is not installed; using local caches only.")
+        if shared_cache['failed_at'] is not None and time.time() - shared_cache['failed_at'] < CACHE_SHARED_RETRY:
+            return None
+        return shared_cache['client']
+
+def mark_shared_cache_failed(error):
+    logger.warning(f"Shared cache unavailable, using local caches for {CACHE_SHARED_RETRY}s: {error}")
+    with shared_cache_lock:
+        shared_cache['failed_at'] = time.time()
+
+class TieredCache:
+    """
+    Read-through cache for JSON-serialisable values under string keys. Shared
+    tier errors are logged and treated as misses, never raised.
+    """
+
+    def __init__(self, namespace, maxsize, ttl):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.snapshot = None
+        self.stats = {'local': 0, 'shared': 0, 'snapshot': 0, 'miss': 0}
+        self.lock = threading.Lock()
+
+    def shared_key(self, key):
+        return f"{CACHE_KEY_PREFIX}{self.namespace}:{key}"
+
+    def load_snapshot(self):
+        if self.snapshot is None:
+            self.snapshot = {}
+            if CACHE_SNAPSHOT_DIR:
+                path = os.path.join(CACHE_SNAPSHOT_DIR, f"{self.namespace}.json")
+                try:
+                    with open(path) as f:
+                        self.snapshot = json.load(f)
+                except FileNotFoundError:
+                    pass
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Could not read cache snapshot {path}: {e}")
+        return self.snapshot
+
+    def peek_local(self, key):
+        with self.lock:
+            return self.local.get(key)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.local:
+                self.stats['local'] += 1
+                return self.local[key]
+
+        client = get_shared_cache_client()
+        if client is not None:
+            try:
+                raw = client.get(self.shared_key(key))
+            except Exception as e:
+                mark_shared_cache_failed(e)
+                raw = None
+            if raw is not None:
+                try:
+                    value = json.loads(raw)
+                except (TypeError, ValueError) as e:
+                    # A corrupt or foreign value is a miss; the next set overwrites it
+                    logger.warning(f"Ignoring undecodable shared cache value for {self.shared_key(key)}: {e}")
+                else:
+                    with self.lock:
+                        self.local[key] = value
+                        self.stats['shared'] += 1
+                    return value
+
+        with self.lock:
+            value = self.load_snapshot().get(key)
+            self.stats['snapshot' if value is not None else 'miss'] += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.local[key] = value
+        client = get_shared_cache_client()
+        if client is not None:
+            try:
+                client.set(self.shared_key(key), json.dumps(value), ex=int(self.ttl))
+            except Exception as e:
+                mark_shared_cache_failed(e)
+
+    def delete(self, key):
+        with self.lock:
+            self.local.pop(key, None)
+        client = get_shared_cache_client()
+        if client is not None:
+            try:
+                client.delete(self.shared_key(key))
+            except Exception as e:
+                mark_shared_cache_failed(e)
+
+class TokenBucket:
+    """
+    Token bucket refilled at rate tokens per second up to capacity.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self, amount=1):
+        """
+        Takes amount tokens if available. Returns (acquired, seconds until
+        enough tokens would be available).
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return True, 0.0
+            return False, (amount - self.tokens) / self.rate if self.rate > 0 else float('inf')
+
+    def acquire(self, amount=1, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            acquired, wait = self.try_acquire(amount)
+            if acquired:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def release(self, amount=1):
+        # Gives back tokens taken for work that was then turned away
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
 
 # Set up API keys
 IMGFLIP_USERNAME = os.environ.get('IMGFLIP_USERNAME')
 IMGFLIP_PASSWORD = os.environ.get('IMGFLIP_PASSWORD')
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
 
-# Initialize OpenAI client
-openai.api_key = OPENAI_API_KEY
+# Upstream base URLs, overridable for proxies and the local stubs in benchmarks/
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+IMGFLIP_BASE_URL = os.environ.get('IMGFLIP_BASE_URL', 'https://api.imgflip.com')
+IPAPI_BASE_URL = os.environ.get('IPAPI_BASE_URL', 'https://ipapi.co')
+
+# Geo-IP resolution. GEOIP_RESOLVERS is the ordered list of resolvers to try: 'mmdb' reads a
+# local MaxMind-format database (e.g. GeoLite2-City.mmdb) at GEOIP_DB_PATH, 'ipapi' calls
+# ipapi.co and is abandoned after GEOIP_FALLBACK_BUDGET seconds. Results are cached per
+# network prefix (/24 for IPv4, /48 for IPv6) rather than per address.
+GEOIP_RESOLVERS = [name.strip() for name in os.environ.get('GEOIP_RESOLVERS', 'mmdb,ipapi').split(',') if name.strip()]
+GEOIP_DB_PATH = os.environ.get('GEOIP_DB_PATH', 'GeoLite2-City.mmdb')
+GEOIP_FALLBACK_BUDGET = float(os.environ.get('GEOIP_FALLBACK_BUDGET', 1.5))
+GEOIP_IPV4_PREFIX = int(os.environ.get('GEOIP_IPV4_PREFIX', 24))
+GEOIP_IPV6_PREFIX = int(os.environ.get('GEOIP_IPV6_PREFIX', 48))
+ip_location_cache = TieredCache('geoip', maxsize=int(os.environ.get('GEOIP_CACHE_SIZE', 50000)), ttl=int(os.environ.get('GEOIP_CACHE_TTL', 86400)))
+# ipapi lookups that overshoot GEOIP_FALLBACK_BUDGET keep running, so they get their own small
+# pool instead of io_executor; lookups beyond its queue limit skip ipapi rather than wait
+GEOIP_FALLBACK_WORKERS = int(os.environ.get('GEOIP_FALLBACK_WORKERS', 4))
+GEOIP_FALLBACK_QUEUE = int(os.environ.get('GEOIP_FALLBACK_QUEUE', 16))
+geoip_fallback_executor = ThreadPoolExecutor(max_workers=GEOIP_FALLBACK_WORKERS, thread_name_prefix='geoip')
+geoip_fallback_slots = threading.BoundedSemaphore(GEOIP_FALLBACK_WORKERS + GEOIP_FALLBACK_QUEUE)
+geoip_reader = {'reader': None, 'loaded': False}
+geoip_reader_lock = threading.Lock()
+USER_LOCATION_COOKIE_MAX_AGE = 30 * 24 * 3600
+
+# Outbound HTTP settings per upstream: (connect, read) timeouts in seconds, retries after
+# the first attempt and the base exponential backoff between them
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+HTTP_UPSTREAMS = {
+    'openai': {
+        'timeout': (float(os.environ.get('OPENAI_CONNECT_TIMEOUT', 3.05)), float(os.environ.get('OPENAI_READ_TIMEOUT', 30))),
+        'retries': int(os.environ.get('OPENAI_RETRIES', 2)),
+        'backoff': float(os.environ.get('OPENAI_BACKOFF', 0.5)),
+    },
+    'imgflip': {
+        'timeout': (float(os.environ.get('IMGFLIP_CONNECT_TIMEOUT', 3.05)), float(os.environ.get('IMGFLIP_READ_TIMEOUT', 10))),
+        'retries': int(os.environ.get('IMGFLIP_RETRIES', 2)),
+        'backoff': float(os.environ.get('IMGFLIP_BACKOFF', 0.5)),
+    },
+    'ipapi': {
+        'timeout': (float(os.environ.get('IPAPI_CONNECT_TIMEOUT', 1)), float(os.environ.get('IPAPI_READ_TIMEOUT', 2))),
+        'retries': int(os.environ.get('IPAPI_RETRIES', 1)),
+        'backoff': float(os.environ.get('IPAPI_BACKOFF', 0.2)),
+    },
+    # Template base images for local caption rendering
+    'template_images': {
+        'timeout': (float(os.environ.get('TEMPLATE_IMAGE_CONNECT_TIMEOUT', 3.05)), float(os.environ.get('TEMPLATE_IMAGE_READ_TIMEOUT', 10))),
+        'retries': int(os.environ.get('TEMPLATE_IMAGE_RETRIES', 2)),
+        'backoff': float(os.environ.get('TEMPLATE_IMAGE_BACKOFF', 0.5)),
+    },
+}
+RETRYABLE_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+# Circuit breaker: after CIRCUIT_BREAKER_FAILURES consecutive failures an upstream is
+# skipped for CIRCUIT_BREAKER_RESET seconds, then a single trial request is let through
+CIRCUIT_BREAKER_FAILURES = int(os.environ.get('CIRCUIT_BREAKER_FAILURES', 5))
+CIRCUIT_BREAKER_RESET = float(os.environ.get('CIRCUIT_BREAKER_RESET', 30))
+http_sessions = {}
+circuit_state = {upstream: {'failures': 0, 'opened_at': None} for upstream in HTTP_UPSTREAMS}
+http_lock = threading.Lock()
+
+# Meme template catalog, refreshed from Imgflip every TEMPLATE_CATALOG_TTL seconds. After a
+# failed refresh the current copy is kept and the next attempt waits TEMPLATE_CATALOG_RETRY
+TEMPLATE_CATALOG_TTL = int(os.environ.get('TEMPLATE_CATALOG_TTL', 6 * 3600))
+TEMPLATE_CATALOG_RETRY = int(os.environ.get('TEMPLATE_CATALOG_RETRY', 300))
+TEMPLATE_CATALOG_PATH = os.environ.get('TEMPLATE_CATALOG_PATH', '/tmp/meme_templates.json')  # /tmp is the only writable path on Vercel
+template_catalog = {'memes': [], 'by_id': {}, 'index': {}, 'fetched_at': 0.0, 'refreshing': False}
+template_catalog_lock = threading.Lock()
+template_catalog_refreshed = threading.Condition(template_catalog_lock)
+template_catalog_cache = TieredCache('templates', maxsize=1, ttl=TEMPLATE_CATALOG_TTL)
+
+# Caption rendering backends, tried in order: 'imgflip' (caption_image API) and 'local'
+# (drawn with Pillow onto cached template images). Locally rendered memes are written to
+# RENDER_DIR under content-hash names and linked as RENDER_BASE_URL/<name>; RENDER_DIR is
+# per instance on Vercel, so point RENDER_BASE_URL at shared storage when scaling out
+CAPTION_BACKENDS = [name.strip() for name in os.environ.get('CAPTION_BACKENDS', 'imgflip').split(',') if name.strip()]
+RENDER_DIR = os.environ.get('RENDER_DIR', '/tmp/rendered_memes')
+RENDER_BASE_URL = os.environ.get('RENDER_BASE_URL', '/rendered').rstrip('/')
+RENDER_CACHE_MAX_AGE = int(os.environ.get('RENDER_CACHE_MAX_AGE', 365 * 24 * 3600))
+RENDER_JPEG_QUALITY = int(os.environ.get('RENDER_JPEG_QUALITY', 85))
+RENDER_FONT_PATHS = os.environ.get('RENDER_FONT_PATHS', 'impact.ttf,Impact.ttf,DejaVuSans-Bold.ttf,/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf').split(',')
+TEMPLATE_IMAGE_DIR = os.environ.get('TEMPLATE_IMAGE_DIR', '/tmp/meme_template_images')
+template_images = TTLCache(maxsize=int(os.environ.get('TEMPLATE_IMAGE_CACHE_SIZE', 64)), ttl=TEMPLATE_CATALOG_TTL)
+template_images_lock = threading.Lock()
+render_fonts = {}
+render_fonts_lock = threading.Lock()
+caption_layouts = TTLCache(maxsize=4096, ttl=3600)
+caption_layouts_lock = threading.Lock()
+
+# LLM settings. GENERATION_MODE is 'single' (template and texts from one JSON completion)
+# or 'two_step' (separate selection and caption completions)
+OPENAI_MODEL = os.environ.get('OPENAI_MODEL', 'gpt-3.5-turbo')
+GENERATION_MODE = os.environ.get('GENERATION_MODE', 'single')
+# Stream completions so the chosen template is known before the rest of the reply has arrived
+OPENAI_STREAM = os.environ.get('OPENAI_STREAM', '0') == '1'
+# Number of locally pre-ranked templates offered to the model (0 sends the whole catalog)
+TEMPLATE_SHORTLIST_SIZE = int(os.environ.get('TEMPLATE_SHORTLIST_SIZE', 20))
+MEME_SYSTEM_PROMPT = "You are an expert in meme creation. Your task is to select the most appropriate meme template based on a given thought, and generate witty and humorous text for the meme. Ensure that the meme is coherent and funny. Don't put too much weight into the location."
+
+# Short usage notes for popular templates, indexed together with the template names
+# when shortlisting. Keyed by Imgflip template name; templates without an entry are
+# matched on their name alone.
+TEMPLATE_DESCRIPTIONS = {
+    'Drake Hotline Bling': 'rejecting one thing and preferring another, dislike versus like',
+    'Two Buttons': 'hard choice between two options, dilemma, cannot decide, sweating',
+    'Distracted Boyfriend': 'tempted by something new while ignoring what you already have, distraction',
+    'Running Away Balloon': 'being held back from what you want, chasing something out of reach',
+    'UNO Draw 25 Cards': 'would rather suffer than do something simple, refusing, stubborn',
+    'Left Exit 12 Off Ramp': 'swerving away from the sensible choice at the last moment',
+    'Change My Mind': 'strong opinion, hot take, debate, prove me wrong',
+    'Expanding Brain': 'escalating levels of enlightenment, ideas getting smarter or dumber',
+    'Woman Yelling At Cat': 'argument, accusation, angry complaint met with confusion',
+    'Disaster Girl': 'smug about chaos, something burning, watching things go wrong',
+    'Batman Slapping Robin': 'shutting down a bad idea, slap, interrupting',
+    'Waiting Skeleton': 'waiting forever, taking too long, still waiting',
+    'One Does Not Simply': 'something much harder than it sounds, impossible task',
+    'This Is Fine': 'pretending everything is okay while things fall apart, denial, burning',
+    'Always Has Been': 'realizing something was true all along, betrayal, discovery',
+    'Tuxedo Winnie The Pooh': 'fancy versus plain way of saying the same thing, classy upgrade',
+    'Roll Safe Think About It': 'clever but flawed logic, smart idea, loophole',
+    'Futurama Fry': 'suspicious, not sure if, doubt, uncertain',
+    'Mocking Spongebob': 'mocking, sarcasm, repeating something in a silly voice',
+    'Is This A Pigeon': 'misunderstanding, mistaking one thing for another, confusion',
+    'Success Kid': 'small victory, win, success, achievement',
+    'Hide the Pain Harold': 'smiling through pain, awkward, hiding discomfort',
+    'Bike Fall': 'self sabotage, causing your own problem then blaming others',
+    'Boardroom Meeting Suggestion': 'sensible suggestion rejected, thrown out the window, meeting, work',
+    'Ancient Aliens': 'absurd explanation, conspiracy, it must be aliens',
+    'Sad Pablo Escobar': 'lonely, waiting, bored, sad',
+    'Epic Handshake': 'two different groups agreeing on something, common ground',
+    'Gru\'s Plan': 'plan that backfires, realizing the flaw in a plan',
+    'Buff Doge vs. Cheems': 'strong past versus weak present, then and now, comparison',
+    'Bernie I Am Once Again Asking For Your Support': 'asking again, begging, requesting help or money',
+}
+
+# Asynchronous generation jobs: a bounded in-process worker pool and a TTL store of job
+# state that /generate_meme/<job_id> reads from. Job state is per process, so this opt-in
+# API only works when the status requests reach the same long-lived process
+GENERATION_WORKERS = int(os.environ.get('GENERATION_WORKERS', 4))
+GENERATION_QUEUE_LIMIT = int(os.environ.get('GENERATION_QUEUE_LIMIT', 32))
+GENERATION_JOB_TTL = int(os.environ.get('GENERATION_JOB_TTL', 600))
+generation_executor = ThreadPoolExecutor(max_workers=GENERATION_WORKERS, thread_name_prefix='generate')
+generation_jobs = TTLCache(maxsize=10000, ttl=GENERATION_JOB_TTL)
+generation_jobs_condition = threading.Condition()
 
-# Initialize the IP location cache and lock
-ip_location_cache = TTLCache(maxsize=1000, ttl=3600)  # Cache up to 1000 IPs for 1 hour
-cache_lock = threading.Lock()  # Use a lock if needed
+# Shared snapshot of the most recent memes for the gallery, bucketed by location tier
+GALLERY_SIZE = int(os.environ.get('GALLERY_SIZE', 100))
+GALLERY_CACHE_TTL = int(os.environ.get('GALLERY_CACHE_TTL', 30))
+gallery_snapshot = {'memes': [], 'city': {}, 'region': {}, 'country': {}, 'fetched_at': 0.0}
+gallery_lock = threading.Lock()
+gallery_refresh_lock = threading.Lock()
+
+# Pushed-down Firestore queries: page sizes and the pool that runs independent upstream calls
+# (location tiers, template catalog) concurrently.
+# Tier results are cached for GALLERY_CACHE_TTL too, including empty ones.
+GALLERY_PAGE_SIZE = int(os.environ.get('GALLERY_PAGE_SIZE', 100))
+LOCATION_QUERY_LIMIT = int(os.environ.get('LOCATION_QUERY_LIMIT', 50))
+LOCATION_TIERS = ('city', 'region', 'country')
+io_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='io')
+gallery_tier_cache = TTLCache(maxsize=1000, ttl=GALLERY_CACHE_TTL)
+gallery_tier_cache_lock = threading.Lock()
+
+# Materialized gallery feeds keyed by resolved (level, value), updated in place as memes are
+# written and served in compact form with ETags. gallery_feed_routes remembers which feed a
+# visitor's (city, region, country) resolved to. Feeds expire after GALLERY_FEED_TTL, which
+# bounds how long memes written by other instances take to show up
+GALLERY_FEED_TTL = int(os.environ.get('GALLERY_FEED_TTL', GALLERY_CACHE_TTL))
+GALLERY_GZIP = os.environ.get('GALLERY_GZIP', '1') == '1'
+GALLERY_GZIP_MIN_SIZE = int(os.environ.get('GALLERY_GZIP_MIN_SIZE', 1024))
+GALLERY_COMPACT_FIELDS = ['id', 'meme_url', 'thought', 'location', 'place', 'ts']
+gallery_feeds = TTLCache(maxsize=1000, ttl=GALLERY_FEED_TTL)
+gallery_feed_routes = TTLCache(maxsize=10000, ttl=GALLERY_FEED_TTL)
+gallery_feeds_lock = threading.Lock()
+
+# Locations this process has already written, so unchanged upserts can be skipped
+written_locations = TTLCache(maxsize=10000, ttl=3600)
+written_locations_lock = threading.Lock()
+
+# With PERSIST_ASYNC, meme writes happen after the response is sent, on a background thread.
+# This needs a long-lived process (e.g. gunicorn on a VM); on Vercel the instance is frozen
+# after the response, so it stays off by default. Pending writes are also spooled to
+# PERSIST_SPOOL_DIR as a best-effort local retry: the spool is only replayed if a process
+# restarts on the same machine, so it is not durable storage.
+PERSIST_ASYNC = os.environ.get('PERSIST_ASYNC', '0') == '1'
+PERSIST_SPOOL_DIR = os.environ.get('PERSIST_SPOOL_DIR', '/tmp/meme_write_spool')
+PERSIST_MAX_ATTEMPTS = int(os.environ.get('PERSIST_MAX_ATTEMPTS', 8))
+persist_queue = queue.Queue()
+persist_worker = {'thread': None}
+persist_worker_lock = threading.Lock()
+
+# Batch generation (/generate_memes): items per request, items generated at once per request,
+# and a process-wide budget of OpenAI requests per second that batch items draw from
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 50))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 4))
+BATCH_OPENAI_RATE = float(os.environ.get('BATCH_OPENAI_RATE', 2))
+BATCH_OPENAI_BURST = int(os.environ.get('BATCH_OPENAI_BURST', 8))
+BATCH_RATE_WAIT = float(os.environ.get('BATCH_RATE_WAIT', 60))
+# Batch items are charged to a per-client budget of items per second (0 disables it) rather
+# than the single-generation rate limits, whose burst is far below BATCH_MAX_ITEMS. Items
+# wait up to BATCH_RATE_WAIT for it like they do for the OpenAI budget
+BATCH_RATE_PER_IP = float(os.environ.get('BATCH_RATE_PER_IP', 0.5))
+BATCH_RATE_PER_IP_BURST = int(os.environ.get('BATCH_RATE_PER_IP_BURST', BATCH_MAX_ITEMS))
+
+batch_openai_budget = TokenBucket(BATCH_OPENAI_RATE, BATCH_OPENAI_BURST)
+batch_client_buckets = TTLCache(maxsize=100000, ttl=3600)
+batch_client_buckets_lock = threading.Lock()
+
+# Admission control for generation requests: token buckets per client IP and for the whole
+# process (requests per second, 0 disables a bucket), at most GENERATION_MAX_INFLIGHT
+# generations running at once and GENERATION_MAX_WAITING requests waiting up to
+# GENERATION_ADMISSION_WAIT seconds for a slot. Anything beyond that is rejected at once
+RATE_LIMIT_PER_IP = float(os.environ.get('RATE_LIMIT_PER_IP', 0.2))
+RATE_LIMIT_PER_IP_BURST = int(os.environ.get('RATE_LIMIT_PER_IP_BURST', 5))
+RATE_LIMIT_GLOBAL = float(os.environ.get('RATE_LIMIT_GLOBAL', 5))
+RATE_LIMIT_GLOBAL_BURST = int(os.environ.get('RATE_LIMIT_GLOBAL_BURST', 20))
+GENERATION_MAX_INFLIGHT = int(os.environ.get('GENERATION_MAX_INFLIGHT', 8))
+GENERATION_MAX_WAITING = int(os.environ.get('GENERATION_MAX_WAITING', 16))
+GENERATION_ADMISSION_WAIT = float(os.environ.get('GENERATION_ADMISSION_WAIT', 5))
+# Regenerating grows the client's excluded list; only the most recent entries are honoured
+GENERATION_MAX_EXCLUDED = int(os.environ.get('GENERATION_MAX_EXCLUDED', 50))
+# Recent memes sent along with a rejection so the client has something to show
+ADMISSION_FALLBACK_MEMES = int(os.environ.get('ADMISSION_FALLBACK_MEMES', 5))
+client_buckets = TTLCache(maxsize=100000, ttl=3600)
+client_buckets_lock = threading.Lock()
+global_generation_bucket = TokenBucket(RATE_LIMIT_GLOBAL, RATE_LIMIT_GLOBAL_BURST)
+generation_slots = threading.BoundedSemaphore(GENERATION_MAX_INFLIGHT)
+admission_state = {'waiting': 0}
+admission_lock = threading.Lock()
+
+# Cache of successful generations keyed on (normalized thought, location, excluded memes).
+# Concurrent identical requests share one pipeline run via generation_inflight.
+GENERATION_CACHE_SIZE = int(os.environ.get('GENERATION_CACHE_SIZE', 1000))
+GENERATION_CACHE_TTL = int(os.environ.get('GENERATION_CACHE_TTL', 600))
+generation_cache = TieredCache('generation', maxsize=GENERATION_CACHE_SIZE, ttl=GENERATION_CACHE_TTL)
+generation_inflight = {}
+generation_cache_stats = {'hits': 0, 'misses': 0, 'shared': 0}
+generation_cache_lock = threading.Lock()
+
+# In-process metrics served at /metrics in the Prometheus text format. Stage latencies are
+# histograms; clients can send TRACE_HEADER: 1 to get a Server-Timing header for their request.
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+TRACE_HEADER = os.environ.get('TRACE_HEADER', 'X-Trace')
+stage_histograms = {}
+metric_counters = {}
+metrics_lock = threading.Lock()
 
 # 3. Helper Functions
+def observe_stage(stage, seconds):
+    with metrics_lock:
+        histogram = stage_histograms.get(stage)
+        if histogram is None:
+            histogram = stage_histograms[stage] = {'buckets': [0] * len(METRIC_BUCKETS), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(METRIC_BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+    if has_request_context() and 'trace' in g:
+        g.trace.append((stage, seconds))
+
+def increment_counter(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metric_counters[key] = metric_counters.get(key, 0) + amount
+
+@contextmanager
+def timed_stage(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+def render_metrics():
+    lines = [
+        '# HELP meme_stage_seconds Latency of each generation and request stage.',
+        '# TYPE meme_stage_seconds histogram'
+    ]
+    with metrics_lock:
+        for stage, histogram in sorted(stage_histograms.items()):
+            for bound, count in zip(METRIC_BUCKETS, histogram['buckets']):
+                lines.append(f'meme_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(f'meme_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'meme_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]:.6f}')
+            lines.append(f'meme_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+
+        counter_names = sorted({name for name, _ in metric_counters})
+        for name in counter_names:
+            lines.append(f'# TYPE {name} counter')
+            for (counter_name, labels), value in sorted(metric_counters.items()):
+                if counter_name == name:
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+
+    lines.append('# TYPE meme_cache_lookups_total counter')
+    ratios = []
+    for cache in (ip_location_cache, template_catalog_cache, generation_cache):
+        stats = dict(cache.stats)
+        for result, value in sorted(stats.items()):
+            lines.append(f'meme_cache_lookups_total{{cache="{cache.namespace}",result="{result}"}} {value}')
+        total = sum(stats.values())
+        ratios.append((cache.namespace, (total - stats['miss']) / total if total else 0.0))
+    with generation_cache_lock:
+        generation_stats = dict(generation_cache_stats)
+    lines.append('# TYPE meme_generation_requests_total counter')
+    for result, value in sorted(generation_stats.items()):
+        lines.append(f'meme_generation_requests_total{{result="{result}"}} {value}')
+    total = sum(generation_stats.values())
+    ratios.append(('generation_results', (generation_stats['hits'] + generation_stats['shared']) / total if total else 0.0))
+
+    lines.append('# TYPE meme_cache_hit_ratio gauge')
+    for cache, ratio in ratios:
+        lines.append(f'meme_cache_hit_ratio{{cache="{cache}"}} {ratio:.4f}')
+    return '\n'.join(lines) + '\n'
+
+
+class UpstreamUnavailable(requests.exceptions.RequestException):
+    """Raised without making a request while an upstream's circuit is open."""
+
+def get_http_session(upstream):
+    # One keep-alive pool per upstream host, shared by all threads
+    with http_lock:
+        session = http_sessions.get(upstream)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            http_sessions[upstream] = session
+        return session
+
+def is_upstream_failure(error):
+    if isinstance(error, UpstreamUnavailable):
+        return False
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+def check_circuit(upstream):
+    with http_lock:
+        state = circuit_state[upstream]
+        if state['opened_at'] is None:
+            return
+        if time.time() - state['opened_at'] < CIRCUIT_BREAKER_RESET:
+            raise UpstreamUnavailable(f"Circuit open for {upstream}")
+        # Half-open: let this request through and keep failing fast for everyone else
+        state['opened_at'] = time.time()
+
+def record_circuit_result(upstream, failed):
+    with http_lock:
+        state = circuit_state[upstream]
+        if not failed:
+            if state['opened_at'] is not None:
+                logger.info(f"Circuit closed for {upstream}.")
+            state['failures'] = 0
+            state['opened_at'] = None
+            return
+        state['failures'] += 1
+        if state['failures'] >= CIRCUIT_BREAKER_FAILURES:
+            if state['opened_at'] is None:
+                logger.warning(f"Circuit opened for {upstream} after {state['failures']} consecutive failures.")
+            state['opened_at'] = time.time()
+
+def http_request(upstream, method, url, **kwargs):
+    """
+    Sends a request to one of HTTP_UPSTREAMS over its pooled session, with the
+    upstream's timeouts and retry policy. Connection errors, timeouts and
+    429/5xx responses are retried and count towards the circuit breaker; other
+    HTTP errors are raised immediately. Returns the successful response.
+    """
+    config = HTTP_UPSTREAMS[upstream]
+    check_circuit(upstream)
+    kwargs.setdefault('timeout', config['timeout'])
+    session = get_http_session(upstream)
+
+    try:
+        for attempt in Retrying(
+            stop=stop_after_attempt(config['retries'] + 1),
+            wait=wait_exponential(multiplier=config['backoff'], max=10),
+            retry=retry_if_exception(is_upstream_failure),
+            reraise=True
+        ):
+            with attempt:
+                response = session.request(method, url, **kwargs)
+                response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        increment_counter('meme_upstream_requests_total', upstream=upstream, outcome=type(e).__name__)
+        if is_upstream_failure(e):
+            record_circuit_result(upstream, failed=True)
+        raise
+
+    increment_counter('meme_upstream_requests_total', upstream=upstream, outcome='ok')
+    record_circuit_result(upstream, failed=False)
+    return response
+
+def unknown_location(ip_address='Unknown IP'):
+    return {
+        'ip': ip_address,
+        'city': 'Unknown City',
+        'region': 'Unknown Region',
+        'country': 'Unknown Country'
+    }
+
+def get_geoip_reader():
+    # Opened once per process; MODE_MMAP shares the file's pages between workers
+    with geoip_reader_lock:
+        if not geoip_reader['loaded']:
+            geoip_reader['loaded'] = True
+            if not os.path.exists(GEOIP_DB_PATH):
+                logger.warning(f"Geo-IP database not found at {GEOIP_DB_PATH}.")
+                return None
+            try:
+                import maxminddb
+            except ImportError:
+                logger.warning("maxminddb is not installed; skipping the offline geo-IP database.")
+                return None
+            geoip_reader['reader'] = maxminddb.open_database(GEOIP_DB_PATH, maxminddb.MODE_MMAP)
+        return geoip_reader['reader']
+
+def resolve_location_mmdb(ip_address):
+    reader = get_geoip_reader()
+    if reader is None:
+        return None
+    record = reader.get(ip_address)
+    if not record:
+        return None
+    subdivisions = record.get('subdivisions') or [{}]
+    return {
+        'city': record.get('city', {}).get('names', {}).get('en', 'Unknown City'),
+        'region': subdivisions[0].get('names', {}).get('en', 'Unknown Region'),
+        'country': record.get('country', {}).get('names', {}).get('en', 'Unknown Country')
+    }
+
+def fetch_ipapi_location(ip_address):
+    location_response = http_request('ipapi', 'GET', f'{IPAPI_BASE_URL}/{ip_address}/json/')
+    location_data = location_response.json()
+    if location_data.get('error'):
+        return None
+    return {
+        'city': location_data.get('city', 'Unknown City'),
+        'region': location_data.get('region', 'Unknown Region'),
+        'country': location_data.get('country_name', 'Unknown Country')
+    }
+
+def fetch_ipapi_location_bounded(ip_address):
+    try:
+        return fetch_ipapi_location(ip_address)
+    finally:
+        geoip_fallback_slots.release()
+
+def resolve_location_ipapi(ip_address):
+    # The request keeps running in the background if it overshoots the budget; we just stop waiting
+    if not geoip_fallback_slots.acquire(blocking=False):
+        logger.warning(f"Too many pending ipapi lookups; not resolving {ip_address}.")
+        return None
+    future = geoip_fallback_executor.submit(fetch_ipapi_location_bounded, ip_address)
+    try:
+        return future.result(timeout=GEOIP_FALLBACK_BUDGET)
+    except FuturesTimeoutError:
+        logger.warning(f"ipapi lookup for {ip_address} exceeded {GEOIP_FALLBACK_BUDGET}s budget.")
+        return None
+
+geoip_resolvers = {
+    'mmdb': resolve_location_mmdb,
+    'ipapi': resolve_location_ipapi,
+}
+
+def ip_cache_key(ip):
+    prefix = GEOIP_IPV4_PREFIX if ip.version == 4 else GEOIP_IPV6_PREFIX
+    return str(ipaddress.ip_network(f"{ip}/{prefix}", strict=False))
 
-@retry(
-    stop=stop_after_attempt(5),
-    wait=wait_exponential(min=1, max=30),
-    retry=retry_if_exception_type(requests.exceptions.RequestException),
-    reraise=True
-)
 def fetch_location_data(ip_address):
     """
-    Fetches the location data using an IP address with exponential backoff.
+    Resolves an IP address to city/region/country with the GEOIP_RESOLVERS
+    chain, caching results per network prefix. Returns None when no resolver
+    knows the address.
     """
-    # Check if IP address is in cache
-    with cache_lock:
-        if ip_address in ip_location_cache:
-            logger.debug(f"Retrieved location data for IP {ip_address} from cache.")
-            return ip_location_cache[ip_address]
-    
     try:
-        # Use ipapi to get location data
-        location_response = requests.get(f'https://ipapi.co/{ip_address}/json/')
-        location_response.raise_for_status()
-        location_data = location_response.json()
-        
-        user_location = {
-            'ip': ip_address,
-            'city': location_data.get('city', 'Unknown City'),
-            'region': location_data.get('region', 'Unknown Region'),
-            'country': location_data.get('country_name', 'Unknown Country')
-        }
-        
-        # Store the location data in the cache
-        with cache_lock:
-            ip_location_cache[ip_address] = user_location
-            logger.debug(f"Stored location data for IP {ip_address} in cache.")
-        
-        return user_location
+        ip = ipaddress.ip_address(ip_address)
+    except ValueError:
+        logger.warning(f"Invalid IP address {ip_address!r}.")
+        return None
+    if not ip.is_global:
+        return None
 
-    except requests.exceptions.HTTPError as http_err:
-        logger.error(f"HTTP error occurred: {http_err}")
-        raise
-    except requests.exceptions.RequestException as req_err:
-        logger.error(f"Request error occurred: {req_err}")
-        raise
+    cache_key = ip_cache_key(ip)
+    cached_location = ip_location_cache.get(cache_key)
+    if cached_location is not None:
+        logger.debug(f"Retrieved location data for {cache_key} from cache.")
+        return dict(cached_location, ip=ip_address)
+
+    for name in GEOIP_RESOLVERS:
+        resolver = geoip_resolvers.get(name)
+        if resolver is None:
+            logger.warning(f"Unknown geo-IP resolver {name!r}.")
+            continue
+        try:
+            location = resolver(ip_address)
+        except Exception as e:
+            logger.error(f"Geo-IP resolver {name} failed for {ip_address}: {str(e)}")
+            continue
+        if location:
+            ip_location_cache.set(cache_key, location)
+            logger.debug(f"Resolved {ip_address} with {name} and cached it for {cache_key}.")
+            return dict(location, ip=ip_address)
+
+    return None
+
+def record_openai_usage(usage, stage):
+    for token_type in ('prompt_tokens', 'completion_tokens'):
+        if usage.get(token_type):
+            increment_counter('meme_openai_tokens_total', usage[token_type], stage=stage, type=token_type)
 
-def call_openai_api(data):
+def stream_openai_api(data, stage='openai', on_content=None):
+    """
+    Requests the completion with stream: true and reads the server-sent
+    events as they arrive. on_content, if given, is called with the text
+    received so far after every chunk. Returns the same shape as a
+    non-streamed completion, or None on error.
+    """
     headers = {
         'Content-Type': 'application/json',
-        'Authorization': f'Bearer {openai.api_key}'
+        'Authorization': f'Bearer {OPENAI_API_KEY}'
     }
+    data = dict(data, stream=True, stream_options={'include_usage': True})
+    content = ''
+    usage = {}
     try:
-        response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=data)
-        response.raise_for_status()
-        return response.json()
-    except Exception as err:
-        print(f"An error occurred: {err}")
+        with timed_stage(stage):
+            response = http_request('openai', 'POST', f"{OPENAI_BASE_URL}/chat/completions", headers=headers, json=data, stream=True)
+            with response:
+                for line in response.iter_lines():
+                    line = line.decode('utf-8')
+                    if not line.startswith('data:'):
+                        continue
+                    payload = line[len('data:'):].strip()
+                    if payload == '[DONE]':
+                        break
+                    chunk = json.loads(payload)
+                    usage = chunk.get('usage') or usage
+                    delta = ''.join((choice.get('delta') or {}).get('content') or '' for choice in chunk.get('choices') or [])
+                    if delta:
+                        content += delta
+                        if on_content:
+                            on_content(content)
+    except (requests.exceptions.RequestException, ValueError) as err:
+        logger.error(f"OpenAI API error: {err}")
         return None
 
+    record_openai_usage(usage, stage)
+    return {'choices': [{'message': {'role': 'assistant', 'content': content}}], 'usage': usage}
+
+def call_openai_api(data, stage='openai', on_content=None):
+    # on_content only fires when OPENAI_STREAM is on
+    if OPENAI_STREAM:
+        return stream_openai_api(data, stage, on_content)
+
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {OPENAI_API_KEY}'
+    }
+    try:
+        with timed_stage(stage):
+            response = http_request('openai', 'POST', f"{OPENAI_BASE_URL}/chat/completions", headers=headers, json=data)
+            result = response.json()
+    except (requests.exceptions.RequestException, ValueError) as err:
+        logger.error(f"OpenAI API error: {err}")
+        return None
+
+    record_openai_usage(result.get('usage') or {}, stage)
+    return result
+
 
 def get_client_ip():
     if request.headers.getlist("X-Forwarded-For"):
         # 'X-Forwarded-For' may contain multiple IPs, take the first one
-        ip = request.headers.getlist("X-Forwarded-For")[0].split(',')[0]
+        ip = request.headers.getlist("X-Forwarded-For")[0].split(',')[0].strip()
     else:
         ip = request.remote_addr
     return ip
 
-def collect_user_ip_and_location():
-    # Check if location data is already stored in the session
+def get_stored_user_location():
+    # The location remembered in the session or cookie, or None; never looks the IP up
     if 'user_location' in session:
         logger.debug("Using cached location from session.")
         return session['user_location']
@@ -122,6 +824,12 @@ def collect_user_ip_and_location():
         session['user_location'] = user_location
         logger.debug("Using cached location from cookies.")
         return user_location
+    return None
+
+def collect_user_ip_and_location():
+    user_location = get_stored_user_location()
+    if user_location is not None:
+        return user_location
 
     try:
         # Get the client's IP address
@@ -130,185 +838,781 @@ def collect_user_ip_and_location():
         # Log the IP address
         logger.debug(f"User IP Address: {ip_address}")
 
-        # Fetch location data with backoff strategy
-        user_location = fetch_location_data(ip_address)
+        with timed_stage('geo_lookup'):
+            user_location = fetch_location_data(ip_address)
+        if user_location is None:
+            return unknown_location(ip_address)
 
-        # Save location data in session and cookie
+        # Save location data in session; the cookie is set on the outgoing response by remember_user_location
         session['user_location'] = user_location
-        resp = make_response(jsonify({"message": "Location data saved"}))
-        resp.set_cookie('user_location', json.dumps(user_location), max_age=3600)
+        g.user_location_cookie = user_location
         
-        return user_location  # Return the user location, not the response
+        return user_location
 
     except Exception as e:
         logger.error(f"Error fetching IP or location data: {str(e)}")
-        return {
-            'ip': 'Unknown IP',
-            'city': 'Unknown City',
-            'region': 'Unknown Region',
-            'country': 'Unknown Country'
-        }
+        return unknown_location()
 
 
-def upsert_location(location_label, city, region, country):
-    try:
-        # Check if the location document already exists
-        location_query = db.collection('locations').where('label', '==', location_label).limit(1).get()
-        
-        if location_query:
-            # Document exists, update it
-            location_ref = location_query[0].reference
-            location_ref.update({
-                'city': city,
-                'region': region,
-                'country': country,
-                'updated_at': firestore.SERVER_TIMESTAMP
-            })
-            logger.debug(f"Location '{location_label}' updated successfully.")
+def location_doc_id(location_label):
+    # Deterministic document ID so a location can be written without looking it up first
+    return hashlib.sha1(location_label.encode('utf-8')).hexdigest()
+
+def upsert_location(batch, location_label, city, region, country):
+    """
+    Adds a set-merge of the location document to batch, unless this process
+    already wrote the same city/region/country for it. Returns the location
+    reference and whether a write was added.
+
+    A blind set-merge can't tell a new document from an existing one, so
+    created_at is no longer written; documents get updated_at instead.
+    """
+    location_ref = get_db().collection('locations').document(location_doc_id(location_label))
+    fields = (city, region, country)
+    with written_locations_lock:
+        if written_locations.get(location_ref.id) == fields:
+            return location_ref, False
+
+    batch.set(location_ref, {
+        'label': location_label,
+        'city': city,
+        'region': region,
+        'country': country,
+        'updated_at': server_timestamp()
+    }, merge=True)
+    return location_ref, True
+
+def save_memes(memes):
+    """
+    Writes (doc_id, meme) pairs and their location upserts in one batched
+    commit, splitting only at Firestore's 500-writes-per-batch limit. meme
+    holds thought, location, city, region, country, meme_url and explanation.
+    Writing the same doc_id again overwrites it, so retries are safe.
+    """
+    db = get_db()
+    batches = [db.batch()]
+    writes_in_batch = 0
+    written = {}
+    for doc_id, meme in memes:
+        if writes_in_batch + 2 > 500:
+            batches.append(db.batch())
+            writes_in_batch = 0
+        batch = batches[-1]
+        location_id = location_doc_id(meme['location'])
+        if location_id in written:
+            location_ref = db.collection('locations').document(location_id)
         else:
-            # Document does not exist, create it
-            db.collection('locations').add({
-                'label': location_label,
-                'city': city,
-                'region': region,
-                'country': country,
-                'created_at': firestore.SERVER_TIMESTAMP
-            })
-            logger.debug(f"Location '{location_label}' created successfully.")
-    except Exception as e:
-        logger.error(f"Error upserting location: {str(e)}")
+            location_ref, location_written = upsert_location(batch, meme['location'], meme['city'], meme['region'], meme['country'])
+            written[location_id] = (meme['city'], meme['region'], meme['country']) if location_written else None
+            writes_in_batch += location_written
+        batch.set(db.collection('memes').document(doc_id), dict(meme, location_id=location_ref.id, timestamp=server_timestamp()))
+        writes_in_batch += 1
 
-def get_meme_list():
+    with timed_stage('firestore_write'):
+        for batch in batches:
+            batch.commit()
+
+    with written_locations_lock:
+        for location_id, fields in written.items():
+            if fields is not None:
+                written_locations[location_id] = fields
+
+def save_meme(meme, doc_id):
+    save_memes([(doc_id, meme)])
+
+def spool_path(doc_id):
+    return os.path.join(PERSIST_SPOOL_DIR, f"{doc_id}.json")
+
+def run_persist_worker():
+    while True:
+        doc_id, meme, attempt = persist_queue.get()
+        try:
+            save_meme(meme, doc_id)
+        except Exception as e:
+            if attempt + 1 >= PERSIST_MAX_ATTEMPTS:
+                # Left in the spool; the next process start retries it
+                logger.error(f"Giving up on storing meme {doc_id} after {attempt + 1} attempts: {str(e)}")
+                continue
+            delay = min(2 ** attempt, 60)
+            logger.warning(f"Error storing meme {doc_id} (attempt {attempt + 1}), retrying in {delay}s: {str(e)}")
+            retry_timer = threading.Timer(delay, persist_queue.put, args=[(doc_id, meme, attempt + 1)])
+            retry_timer.daemon = True
+            retry_timer.start()
+            continue
+
+        try:
+            os.remove(spool_path(doc_id))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not remove spooled meme {doc_id}: {e}")
+        # Only committed memes are shown in the gallery
+        add_meme_to_gallery(dict(meme, id=doc_id, timestamp=datetime.now(timezone.utc)))
+        logger.debug(f"Stored meme {doc_id} in Firebase.")
+
+def ensure_persist_worker():
+    # Started on first use; replays writes spooled by a previous process
+    with persist_worker_lock:
+        if persist_worker['thread'] is not None:
+            return
+        try:
+            for filename in sorted(os.listdir(PERSIST_SPOOL_DIR)):
+                if filename.endswith('.json'):
+                    with open(os.path.join(PERSIST_SPOOL_DIR, filename)) as f:
+                        persist_queue.put((filename[:-len('.json')], json.load(f), 0))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not replay spooled meme writes: {e}")
+        persist_worker['thread'] = threading.Thread(target=run_persist_worker, name='persist', daemon=True)
+        persist_worker['thread'].start()
+
+def queue_meme_write(doc_id, meme):
+    ensure_persist_worker()
+    try:
+        os.makedirs(PERSIST_SPOOL_DIR, exist_ok=True)
+        with open(spool_path(doc_id), 'w') as f:
+            json.dump(meme, f)
+    except OSError as e:
+        logger.warning(f"Could not spool meme {doc_id}, keeping it in memory only: {e}")
+    persist_queue.put((doc_id, meme, 0))
+
+def persist_meme(meme):
+    """
+    Stores the meme (see save_memes) and adds it to the gallery snapshot once
+    it is committed. With PERSIST_ASYNC the write is queued instead of
+    awaited, and the persist worker adds it to the gallery after the commit.
+    Returns the meme's document ID, which is assigned client-side.
+    """
+    doc_id = get_db().collection('memes').document().id
+    if PERSIST_ASYNC:
+        queue_meme_write(doc_id, meme)
+        return doc_id
+
+    save_meme(meme, doc_id)
+    add_meme_to_gallery(dict(meme, id=doc_id, timestamp=datetime.now(timezone.utc)))
+    return doc_id
+
+def fetch_meme_templates():
+    """
+    Fetches the top 100 meme templates from Imgflip. Raises on failure.
+    """
+    response = http_request('imgflip', 'GET', f"{IMGFLIP_BASE_URL}/get_memes")
+    data = response.json()
+    memes = data['data']['memes']
+    return [{'name': meme['name'], 'id': meme['id'], 'box_count': meme['box_count'], 'url': meme.get('url')} for meme in memes[:100]]
+
+def set_template_catalog(memes, fetched_at):
+    # Build the id-keyed and keyword indexes alongside the ordered list
+    index = build_template_index(memes)
+    with template_catalog_lock:
+        template_catalog['memes'] = memes
+        template_catalog['by_id'] = {meme['id']: meme for meme in memes}
+        template_catalog['index'] = index
+        template_catalog['fetched_at'] = fetched_at
+
+def save_template_snapshot(memes):
+    try:
+        tmp_path = f"{TEMPLATE_CATALOG_PATH}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'fetched_at': time.time(), 'memes': memes}, f)
+        os.replace(tmp_path, TEMPLATE_CATALOG_PATH)
+    except OSError as e:
+        logger.warning(f"Could not write meme template snapshot: {e}")
+
+def load_template_snapshot():
+    try:
+        with open(TEMPLATE_CATALOG_PATH) as f:
+            snapshot = json.load(f)
+        return snapshot['memes'], snapshot.get('fetched_at', 0.0)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"Could not read meme template snapshot: {e}")
+        return None, None
+
+def refresh_template_catalog():
     try:
-        response = requests.get("https://api.imgflip.com/get_memes")
-        response.raise_for_status()
-        data = response.json()
-        memes = data['data']['memes']
-        return [{'name': meme['name'], 'id': meme['id'], 'box_count': meme['box_count']} for meme in memes[:100]]
-    except requests.RequestException as e:
+        # Another instance may already have refreshed the catalog
+        cached = template_catalog_cache.get('catalog')
+        if cached and cached['fetched_at'] > template_catalog['fetched_at'] and time.time() - cached['fetched_at'] <= TEMPLATE_CATALOG_TTL:
+            set_template_catalog(cached['memes'], cached['fetched_at'])
+            logger.debug("Loaded meme template catalog from cache.")
+            return
+
+        memes = fetch_meme_templates()
+        fetched_at = time.time()
+        set_template_catalog(memes, fetched_at)
+        template_catalog_cache.set('catalog', {'memes': memes, 'fetched_at': fetched_at})
+        save_template_snapshot(memes)
+        logger.debug(f"Refreshed meme template catalog ({len(memes)} templates).")
+    except (requests.RequestException, ValueError, KeyError) as e:
         logger.error(f"Error fetching meme list: {e}")
-        return []
+        # Keep serving the copy we already have; fall back to disk if we have nothing
+        if not template_catalog['memes']:
+            memes, fetched_at = load_template_snapshot()
+            if memes:
+                set_template_catalog(memes, fetched_at)
+                logger.debug("Loaded meme template catalog from disk snapshot.")
+        # Mark the copy we serve stale again only after TEMPLATE_CATALOG_RETRY, so requests
+        # don't start a refresh each while Imgflip is down
+        with template_catalog_lock:
+            if template_catalog['memes']:
+                retry_at = time.time() - TEMPLATE_CATALOG_TTL + TEMPLATE_CATALOG_RETRY
+                template_catalog['fetched_at'] = max(template_catalog['fetched_at'], retry_at)
 
-def generate_meme(thought, location_label, meme_id=None, previous_doc_id=None, excluded_memes=None):
+def run_template_catalog_refresh():
+    # The caller sets template_catalog['refreshing'], so only one refresh runs at a time
     try:
-        # Collect user IP and location data
-        user_data = collect_user_ip_and_location()
-        city = user_data['city']
-        region = user_data['region']
-        country = user_data['country']
-        
-        # Upsert location document in Firestore
-        upsert_location(location_label, city, region, country)
-        
-        # Fetch available memes and exclude previously generated ones
-        meme_list = get_meme_list()
-        if excluded_memes:
-            meme_list = [meme for meme in meme_list if meme['id'] not in excluded_memes]
-        if not meme_list:
-            return None, None, None, "Error: No more memes available"
-            
-        if meme_id:
-            selected_meme = next((meme for meme in meme_list if meme['id'] == meme_id), None)
-            if not selected_meme:
-                return None, None, None, f"Meme with ID {meme_id} not found in meme list"
-            box_count = selected_meme['box_count']
-        else:
-            meme_list_str = "\n".join(
-                [f"{meme['name']} (ID: {meme['id']}, box_count: {meme['box_count']})" for meme in meme_list]
-            )
+        refresh_template_catalog()
+    finally:
+        with template_catalog_lock:
+            template_catalog['refreshing'] = False
+            template_catalog_refreshed.notify_all()
 
-            messages = [
-                {"role": "system", "content": "You are an expert in meme creation. Your task is to select the most appropriate meme template based on a given thought, and generate witty and humorous text for the meme. Ensure that the meme is coherent and funny. Don't put too much weight into the location."},
-                {"role": "user", "content": f"The person is at the following location: {location_label}. This is their thought: {thought}\n\nHere is a list of available memes and their respective IDs and box counts:\n{meme_list_str}\n\nBased on this thought, which meme template would be the best fit?\nPlease provide:\nmeme: <name of meme>\nmeme_id: <id of meme>\nexplanation: <reason for the choice>"}
-            ]
+def get_template_catalog():
+    """
+    Returns the cached template catalog, refreshing it once it is older than
+    TEMPLATE_CATALOG_TTL. Stale entries keep being served while a background
+    refresh runs. When the catalog is empty, one request loads it and the
+    others wait for that load instead of calling Imgflip themselves.
+    """
+    with template_catalog_lock:
+        is_empty = not template_catalog['memes']
+        is_stale = time.time() - template_catalog['fetched_at'] > TEMPLATE_CATALOG_TTL
+        start_refresh = (is_stale or is_empty) and not template_catalog['refreshing']
+        if start_refresh:
+            template_catalog['refreshing'] = True
+        elif is_empty:
+            template_catalog_refreshed.wait_for(lambda: not template_catalog['refreshing'])
 
-            data = {
-                "model": "gpt-3.5-turbo",
-                "temperature": .9,
-                "messages": messages
-            }
+    if is_empty and start_refresh:
+        run_template_catalog_refresh()
+    elif start_refresh:
+        threading.Thread(target=run_template_catalog_refresh, daemon=True).start()
 
-            response = call_openai_api(data)
-            if response is None:
-                return None, None, None, "Failed to get response from OpenAI API"
+    with template_catalog_lock:
+        return template_catalog['memes'], template_catalog['by_id']
 
-            meme_info = response['choices'][0]['message']['content']
-            meme_dict = {line.split(": ")[0].strip(): line.split(": ")[1].strip() for line in meme_info.split("\n") if ": " in line}
+STOP_WORDS = frozenset(
+    "a an and are as at be but by for from has have i if in is it its me my of on or so that the this to was "
+    "we were what when with you your our they them just not no do does did am been being im its dont".split()
+)
 
-            meme_id = meme_dict.get('meme_id')
-            if not meme_id:
-                return None, None, None, "Failed to retrieve meme_id from OpenAI response."
+def tokenize(text):
+    tokens = []
+    for word in re.findall(r"[a-z0-9]+", text.lower().replace("'", "")):
+        if word in STOP_WORDS or len(word) < 2:
+            continue
+        # Crude plural folding is enough for short names and notes
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
 
-            selected_meme = next((meme for meme in meme_list if meme['id'] == meme_id), None)
-            if not selected_meme:
-                return None, None, None, f"Meme with ID {meme_id} not found in meme list"
+def build_template_index(memes):
+    """
+    Builds a TF-IDF index over template names and TEMPLATE_DESCRIPTIONS.
+    Returns {'idf': {term: idf}, 'vectors': {meme_id: {term: weight}}} with
+    L2-normalised document vectors.
+    """
+    documents = {meme['id']: Counter(tokenize(f"{meme['name']} {TEMPLATE_DESCRIPTIONS.get(meme['name'], '')}")) for meme in memes}
+    document_frequency = Counter(term for terms in documents.values() for term in terms)
+    idf = {term: math.log((1 + len(documents)) / (1 + df)) + 1 for term, df in document_frequency.items()}
 
-            box_count = selected_meme['box_count']
+    vectors = {}
+    for meme_id, terms in documents.items():
+        weights = {term: count * idf[term] for term, count in terms.items()}
+        norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1.0
+        vectors[meme_id] = {term: weight / norm for term, weight in weights.items()}
+    return {'idf': idf, 'vectors': vectors}
 
-        # Prompt for text boxes
-        text_box_prompt = f"Great choice! Now, the selected meme requires {box_count} text boxes (from text0 to text{box_count - 1}). Please provide the text for each text box, ensuring that the combined texts create a coherent and humorous meme that relates to the thought and location:\n"
-        for i in range(box_count):
-            text_box_prompt += f"text{i}: <text for text box {i}>\n"
+def shortlist_templates(thought, meme_list, k=None):
+    """
+    Returns the k templates from meme_list that best match the thought. Ties
+    (including templates with no matching terms) keep catalog order, which
+    is Imgflip's popularity ranking.
+    """
+    k = TEMPLATE_SHORTLIST_SIZE if k is None else k
+    if k <= 0 or len(meme_list) <= k:
+        return meme_list
 
-        messages.append({"role": "assistant", "content": meme_info})
-        messages.append({"role": "user", "content": text_box_prompt})
+    with template_catalog_lock:
+        index = template_catalog['index']
+    if not index:
+        return meme_list[:k]
 
-        data['messages'] = messages
+    query = Counter(tokenize(thought))
+    query_weights = {term: count * index['idf'][term] for term, count in query.items() if term in index['idf']}
 
-        response = call_openai_api(data)
-        if response is None:
-            return None, None, None, "Failed to get response from OpenAI API"
+    def score(meme):
+        vector = index['vectors'].get(meme['id'], {})
+        return sum(weight * vector.get(term, 0.0) for term, weight in query_weights.items())
 
-        text_boxes_info = response['choices'][0]['message']['content']
-        text_boxes = {line.split(": ")[0].strip(): line.split(": ")[1].strip() for line in text_boxes_info.split("\n") if ": " in line}
+    ranked = sorted(enumerate(meme_list), key=lambda item: (-score(item[1]), item[0]))
+    return [meme for _, meme in ranked[:k]]
 
-        # Prepare parameters for Imgflip API
-        url = "https://api.imgflip.com/caption_image"
-        params = {
-            "template_id": meme_id,
-            "username": IMGFLIP_USERNAME,
-            "password": IMGFLIP_PASSWORD,
-        }
+def get_meme_list():
+    memes, _ = get_template_catalog()
+    return memes
 
-        if box_count > 2:
-            for i in range(box_count):
-                text_key = f"text{i}"
-                text_value = text_boxes.get(text_key, '')
-                params[f'boxes[{i}][text]'] = text_value
-        else:
-            params['text0'] = text_boxes.get('text0', '')
-            params['text1'] = text_boxes.get('text1', '')
+def format_meme_list(meme_list):
+    return "\n".join(
+        [f"{meme['name']} (ID: {meme['id']}, box_count: {meme['box_count']})" for meme in meme_list]
+    )
+
+def parse_labeled_lines(content):
+    # Parses "key: value" lines from a completion; values may themselves contain ": "
+    return {line.split(": ", 1)[0].strip(): line.split(": ", 1)[1].strip() for line in content.split("\n") if ": " in line}
+
+# Match a meme_id only once its value is complete: the line has ended, or the JSON value is closed
+STREAMED_MEME_ID_PATTERNS = {
+    'lines': re.compile(r'^meme_id:\s*(\S+)[ \t]*\n', re.MULTILINE),
+    'json': re.compile(r'"meme_id"\s*:\s*"?([^",}\s]+)"?\s*[,}]'),
+}
+
+def watch_for_template(reply_format, memes_by_id, excluded_ids, on_template):
+    """
+    Returns an on_content callback for call_openai_api that calls
+    on_template(meme) once, as soon as a usable meme_id has streamed in.
+    """
+    if on_template is None:
+        return None
+    pattern = STREAMED_MEME_ID_PATTERNS[reply_format]
+    seen = {'done': False}
+
+    def on_content(content):
+        if seen['done']:
+            return
+        match = pattern.search(content)
+        if not match:
+            return
+        seen['done'] = True
+        meme_id = match.group(1)
+        if meme_id in memes_by_id and meme_id not in excluded_ids:
+            on_template(memes_by_id[meme_id])
+    return on_content
+
+def build_selection_messages(thought, location_label, meme_list):
+    return [
+        {"role": "system", "content": MEME_SYSTEM_PROMPT},
+        {"role": "user", "content": f"The person is at the following location: {location_label}. This is their thought: {thought}\n\nHere is a list of available memes and their respective IDs and box counts:\n{format_meme_list(meme_list)}\n\nBased on this thought, which meme template would be the best fit?\nPlease provide:\nmeme: <name of meme>\nmeme_id: <id of meme>\nexplanation: <reason for the choice>"}
+    ]
+
+def build_single_call_messages(thought, location_label, meme_list):
+    return [
+        {"role": "system", "content": MEME_SYSTEM_PROMPT},
+        {"role": "user", "content": f"The person is at the following location: {location_label}. This is their thought: {thought}\n\nHere is a list of available memes and their respective IDs and box counts:\n{format_meme_list(meme_list)}\n\nPick the meme template that fits this thought best and write the text for each of its text boxes, ensuring that the combined texts create a coherent and humorous meme.\nRespond with a JSON object of the form:\n{{\"meme\": \"<name of meme>\", \"meme_id\": \"<id of meme>\", \"explanation\": \"<reason for the choice>\", \"texts\": [\"<text for text box 0>\", ...]}}\nThe texts list must contain exactly box_count entries for the chosen meme, in box order."}
+    ]
+
+def request_text_boxes(messages, selected_meme):
+    box_count = selected_meme['box_count']
+    text_box_prompt = f"Great choice! Now, the selected meme requires {box_count} text boxes (from text0 to text{box_count - 1}). Please provide the text for each text box, ensuring that the combined texts create a coherent and humorous meme that relates to the thought and location:\n"
+    for i in range(box_count):
+        text_box_prompt += f"text{i}: <text for text box {i}>\n"
+
+    data = {
+        "model": OPENAI_MODEL,
+        "temperature": .9,
+        "messages": messages + [{"role": "user", "content": text_box_prompt}]
+    }
+
+    response = call_openai_api(data, stage='openai_caption')
+    if response is None:
+        return None, "Failed to get response from OpenAI API"
+
+    text_boxes_info = response['choices'][0]['message']['content']
+    return parse_labeled_lines(text_boxes_info), None
+
+def generate_meme_text_two_step(thought, location_label, meme_list, memes_by_id, excluded_ids, meme_id=None, on_template=None):
+    """
+    Original flow: one completion picks the template, a second one (with the
+    conversation resent) writes text0..textN for it. With OPENAI_STREAM,
+    on_template is called as soon as the meme_id line has arrived.
+    """
+    if meme_id:
+        selected_meme = memes_by_id[meme_id]
+        messages = [
+            {"role": "system", "content": MEME_SYSTEM_PROMPT},
+            {"role": "user", "content": f"The person is at the following location: {location_label}. This is their thought: {thought}\n\nThe meme template to use is {format_meme_list([selected_meme])}."}
+        ]
+        text_boxes, error = request_text_boxes(messages, selected_meme)
+        return selected_meme, text_boxes, '', error
+
+    messages = build_selection_messages(thought, location_label, meme_list)
+
+    data = {
+        "model": OPENAI_MODEL,
+        "temperature": .9,
+        "messages": messages
+    }
+
+    response = call_openai_api(data, stage='openai_select', on_content=watch_for_template('lines', memes_by_id, excluded_ids, on_template))
+    if response is None:
+        return None, None, None, "Failed to get response from OpenAI API"
+
+    meme_info = response['choices'][0]['message']['content']
+    meme_dict = parse_labeled_lines(meme_info)
+
+    meme_id = meme_dict.get('meme_id')
+    if not meme_id:
+        return None, None, None, "Failed to retrieve meme_id from OpenAI response."
+
+    selected_meme = memes_by_id.get(meme_id) if meme_id not in excluded_ids else None
+    if not selected_meme:
+        return None, None, None, f"Meme with ID {meme_id} not found in meme list"
+
+    messages.append({"role": "assistant", "content": meme_info})
+    text_boxes, error = request_text_boxes(messages, selected_meme)
+    return selected_meme, text_boxes, meme_dict.get('explanation', ''), error
+
+def generate_meme_text_single_call(thought, location_label, meme_list, memes_by_id, excluded_ids, meme_id=None, on_template=None):
+    """
+    Picks the template and writes all of its box texts in one JSON completion.
+    If the reply does not match the template's box_count, the texts are
+    requested again for the chosen template with the two-step caption prompt.
+    With OPENAI_STREAM, on_template is called as soon as meme_id has arrived.
+    """
+    candidates = [memes_by_id[meme_id]] if meme_id else meme_list
+    messages = build_single_call_messages(thought, location_label, candidates)
+
+    data = {
+        "model": OPENAI_MODEL,
+        "temperature": .9,
+        "messages": messages,
+        "response_format": {"type": "json_object"}
+    }
+
+    # A fixed template is already known, so there is nothing to watch for
+    on_content = None if meme_id else watch_for_template('json', memes_by_id, excluded_ids, on_template)
+    response = call_openai_api(data, stage='openai_generate', on_content=on_content)
+    if response is None:
+        return None, None, None, "Failed to get response from OpenAI API"
+
+    meme_info = response['choices'][0]['message']['content']
+    try:
+        meme_dict = json.loads(meme_info)
+    except ValueError:
+        return None, None, None, "Failed to parse JSON from OpenAI response."
+    if not isinstance(meme_dict, dict):
+        return None, None, None, "Failed to parse JSON from OpenAI response."
+
+    if meme_id:
+        # The template was fixed by the caller; only the texts come from the model
+        selected_meme = memes_by_id[meme_id]
+    else:
+        meme_id = str(meme_dict.get('meme_id') or '')
+        if not meme_id:
+            return None, None, None, "Failed to retrieve meme_id from OpenAI response."
+        selected_meme = memes_by_id.get(meme_id) if meme_id not in excluded_ids else None
+    if not selected_meme:
+        return None, None, None, f"Meme with ID {meme_id} not found in meme list"
+
+    explanation = str(meme_dict.get('explanation') or '')
+    texts = meme_dict.get('texts')
+    if not isinstance(texts, list) or len(texts) != selected_meme['box_count']:
+        logger.warning(f"OpenAI returned {len(texts) if isinstance(texts, list) else 'no'} texts for meme {meme_id} with box_count {selected_meme['box_count']}; requesting them separately.")
+        messages.append({"role": "assistant", "content": meme_info})
+        text_boxes, error = request_text_boxes(messages, selected_meme)
+        return selected_meme, text_boxes, explanation, error
+
+    text_boxes = {f"text{i}": str(text) for i, text in enumerate(texts)}
+    return selected_meme, text_boxes, explanation, None
+
+def caption_meme_imgflip(selected_meme, text_boxes):
+    """
+    Renders the caption with Imgflip. Returns (meme_url, error).
+    """
+    box_count = selected_meme['box_count']
+
+    # Prepare parameters for Imgflip API
+    url = f"{IMGFLIP_BASE_URL}/caption_image"
+    params = {
+        "template_id": selected_meme['id'],
+        "username": IMGFLIP_USERNAME,
+        "password": IMGFLIP_PASSWORD,
+    }
 
-        response = requests.post(url, data=params)
+    if box_count > 2:
+        for i in range(box_count):
+            text_key = f"text{i}"
+            text_value = text_boxes.get(text_key, '')
+            params[f'boxes[{i}][text]'] = text_value
+    else:
+        params['text0'] = text_boxes.get('text0', '')
+        params['text1'] = text_boxes.get('text1', '')
+
+    with timed_stage('imgflip_caption'):
+        response = http_request('imgflip', 'POST', url, data=params)
         result = response.json()
 
-        if result['success']:
-            meme_url = result['data']['url']
-            
-            # Find the location document reference
-            location_query = db.collection('locations').where('label', '==', location_label).limit(1).get()
-            location_id = location_query[0].id if location_query else None
+    if not result['success']:
+        error_msg = f"Failed to generate meme. {result.get('error_message', '')}"
+        logger.error(error_msg)
+        return None, error_msg
+    return result['data']['url'], None
+
+def template_image_path(meme):
+    extension = os.path.splitext(meme['url'])[1] or '.jpg'
+    return os.path.join(TEMPLATE_IMAGE_DIR, f"{meme['id']}{extension}")
+
+def write_file_atomically(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+def get_template_image(meme):
+    """
+    Returns the decoded base image of a template, downloading it into
+    TEMPLATE_IMAGE_DIR on first use. Callers must copy it before drawing.
+    """
+    from PIL import Image
+
+    with template_images_lock:
+        image = template_images.get(meme['id'])
+    if image is not None:
+        return image
+
+    path = template_image_path(meme)
+    if not os.path.exists(path):
+        with timed_stage('template_image_download'):
+            response = http_request('template_images', 'GET', meme['url'])
+        write_file_atomically(path, response.content)
+    with Image.open(path) as source:
+        image = source.convert('RGB')
 
-            # Save meme to Firebase
+    with template_images_lock:
+        template_images[meme['id']] = image
+    return image
+
+def get_render_font(size):
+    with render_fonts_lock:
+        font = render_fonts.get(size)
+        if font is not None:
+            return font
+
+        from PIL import ImageFont
+        for path in RENDER_FONT_PATHS:
             try:
-                write_time, doc_ref = db.collection('memes').add({
-                    'thought': thought,
-                    'location': location_label,
-                    'location_id': location_id,
-                    'city': city,  # Adding city information
-                    'region': region,  # Adding region information
-                    'country': country,  # Adding country information
-                    'meme_url': meme_url,
-                    'explanation': meme_dict.get('explanation', ''),
-                    'timestamp': firestore.SERVER_TIMESTAMP
-                })
-                return meme_url, meme_id, doc_ref.id, None
-            except Exception as e:
-                error_msg = f"Error storing meme in Firebase: {str(e)}"
-                logger.error(error_msg)
-                return None, None, None, error_msg
+                font = ImageFont.truetype(path.strip(), size)
+                break
+            except OSError:
+                continue
+        else:
+            logger.warning("None of RENDER_FONT_PATHS could be loaded; using Pillow's default font.")
+            try:
+                font = ImageFont.load_default(size=size)
+            except TypeError:
+                font = ImageFont.load_default()
+        render_fonts[size] = font
+        return font
+
+def caption_box_positions(width, height, box_count):
+    # Imgflip's per-template box positions aren't in its API: use top and bottom
+    # for up to two boxes, otherwise stack the boxes in equal horizontal bands
+    margin = int(width * 0.03)
+    if box_count <= 2:
+        band = height // 4
+        boxes = [(margin, margin, width - margin, band), (margin, height - band, width - margin, height - margin)]
+        return boxes[:box_count]
+    band = height / box_count
+    return [(margin, int(i * band) + margin, width - margin, int((i + 1) * band) - margin) for i in range(box_count)]
+
+def wrap_caption(text, font, max_width):
+    lines = []
+    for word in text.split():
+        if lines and font.getlength(f"{lines[-1]} {word}") <= max_width:
+            lines[-1] = f"{lines[-1]} {word}"
         else:
-            error_msg = f"Failed to generate meme. {result.get('error_message', '')}"
+            lines.append(word)
+    return lines
+
+def layout_caption(text, box_width, box_height):
+    """
+    Finds the largest font size at which the word-wrapped text fits the box.
+    Returns (font_size, lines); cached per text and box size.
+    """
+    key = (text, box_width, box_height)
+    with caption_layouts_lock:
+        layout = caption_layouts.get(key)
+    if layout is not None:
+        return layout
+
+    size = max(12, min(box_height, box_width // 6))
+    while True:
+        font = get_render_font(size)
+        lines = wrap_caption(text, font, box_width)
+        fits = len(lines) * size * 1.15 <= box_height and all(font.getlength(line) <= box_width for line in lines)
+        if fits or size <= 12:
+            break
+        size = max(12, int(size * 0.85))
+
+    layout = (size, lines)
+    with caption_layouts_lock:
+        caption_layouts[key] = layout
+    return layout
+
+def draw_caption(draw, text, box):
+    left, top, right, bottom = box
+    size, lines = layout_caption(text.upper(), right - left, bottom - top)
+    font = get_render_font(size)
+    line_height = int(size * 1.15)
+    y = top + (bottom - top - line_height * len(lines)) // 2
+    for line in lines:
+        x = left + (right - left - font.getlength(line)) / 2
+        draw.text((x, y), line, font=font, fill='white', stroke_width=max(1, size // 15), stroke_fill='black')
+        y += line_height
+
+def caption_meme_local(selected_meme, text_boxes):
+    """
+    Draws the captions onto the cached template image and stores the JPEG in
+    RENDER_DIR, named by the hash of its content. Returns (meme_url, error).
+    """
+    try:
+        from PIL import ImageDraw
+    except ImportError:
+        return None, "Pillow is not installed; local caption rendering is unavailable."
+    if not selected_meme.get('url'):
+        return None, f"No image URL for meme template {selected_meme['id']}."
+
+    base_image = get_template_image(selected_meme)
+    with timed_stage('local_render'):
+        image = base_image.copy()
+        draw = ImageDraw.Draw(image)
+        for i, box in enumerate(caption_box_positions(image.width, image.height, selected_meme['box_count'])):
+            text = str(text_boxes.get(f"text{i}", '')).strip()
+            if text:
+                draw_caption(draw, text, box)
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=RENDER_JPEG_QUALITY, optimize=True)
+        content = output.getvalue()
+
+    filename = f"{hashlib.sha256(content).hexdigest()[:32]}.jpg"
+    path = os.path.join(RENDER_DIR, filename)
+    if not os.path.exists(path):
+        write_file_atomically(path, content)
+    return f"{RENDER_BASE_URL}/{filename}", None
+
+caption_backends = {
+    'imgflip': caption_meme_imgflip,
+    'local': caption_meme_local,
+}
+
+def caption_meme(selected_meme, text_boxes):
+    """
+    Renders the meme with the first of CAPTION_BACKENDS that succeeds.
+    Returns (meme_url, error).
+    """
+    error = "No caption backend is configured."
+    for name in CAPTION_BACKENDS:
+        backend = caption_backends.get(name)
+        if backend is None:
+            logger.warning(f"Unknown caption backend {name!r}.")
+            continue
+        try:
+            meme_url, error = backend(selected_meme, text_boxes)
+        except Exception as e:
+            if name == CAPTION_BACKENDS[-1]:
+                raise
+            logger.error(f"Caption backend {name} failed for meme {selected_meme['id']}: {str(e)}")
+            continue
+        if not error:
+            return meme_url, None
+        logger.warning(f"Caption backend {name} failed for meme {selected_meme['id']}: {error}")
+    return None, error
+
+def create_meme(thought, location_label, all_memes, memes_by_id, excluded_memes=None, meme_id=None, report_stage=None):
+    """
+    Picks a template, writes the captions and renders the image, without
+    storing anything. Returns (meme_url, selected_meme, explanation, error).
+    """
+    report_stage = report_stage or (lambda stage, **details: None)
+    excluded_ids = set(excluded_memes or ())
+    meme_list = [meme for meme in all_memes if meme['id'] not in excluded_ids] if excluded_ids else all_memes
+    if not meme_list:
+        return None, None, None, "Error: No more memes available"
+        
+    if meme_id and (meme_id in excluded_ids or meme_id not in memes_by_id):
+        return None, None, None, f"Meme with ID {meme_id} not found in meme list"
+
+    # Only offer the model the templates that best match the thought
+    if not meme_id:
+        meme_list = shortlist_templates(thought, meme_list)
+
+    announced = []
+
+    def announce_template(meme):
+        # Lets streaming clients show the template while its captions are still being written
+        if not announced:
+            announced.append(meme['id'])
+            report_stage('template', meme_id=meme['id'], name=meme['name'], url=meme.get('url'))
+            # Fetch the base image for local rendering while the captions are being written
+            if 'local' in CAPTION_BACKENDS and meme.get('url'):
+                io_executor.submit(get_template_image, meme)
+
+    if GENERATION_MODE == 'two_step':
+        selected_meme, text_boxes, explanation, error = generate_meme_text_two_step(thought, location_label, meme_list, memes_by_id, excluded_ids, meme_id, announce_template)
+    else:
+        selected_meme, text_boxes, explanation, error = generate_meme_text_single_call(thought, location_label, meme_list, memes_by_id, excluded_ids, meme_id, announce_template)
+    if error:
+        return None, None, None, error
+    announce_template(selected_meme)
+    report_stage('text')
+
+    meme_url, error = caption_meme(selected_meme, text_boxes)
+    if error:
+        return None, None, None, error
+    report_stage('caption')
+    return meme_url, selected_meme, explanation, None
+
+def generate_meme(thought, location_label, meme_id=None, previous_doc_id=None, excluded_memes=None, user_data=None, on_stage=None):
+    """
+    Runs the full generation pipeline. user_data must be passed when called
+    outside a request context; on_stage, if given, is called with the name
+    of each stage as it completes, plus keyword details for some stages
+    (the 'template' stage carries the chosen template's id, name and url).
+    """
+    report_stage = on_stage or (lambda stage, **details: None)
+    try:
+        # Load the template catalog while the user's location is being resolved
+        catalog_future = io_executor.submit(get_template_catalog)
+
+        # Collect user IP and location data
+        if user_data is None:
+            user_data = collect_user_ip_and_location()
+        city = user_data['city']
+        region = user_data['region']
+        country = user_data['country']
+        
+        report_stage('location')
+        
+        # Fetch available memes
+        with timed_stage('template_catalog'):
+            all_memes, memes_by_id = catalog_future.result()
+        report_stage('templates')
+
+        meme_url, selected_meme, explanation, error = create_meme(
+            thought, location_label, all_memes, memes_by_id, excluded_memes, meme_id, report_stage
+        )
+        if error:
+            return None, None, None, error
+        meme_id = selected_meme['id']
+
+        # Save meme and location to Firebase in one batch, off the response path
+        try:
+            doc_id = persist_meme({
+                'thought': thought,
+                'location': location_label,
+                'city': city,
+                'region': region,
+                'country': country,
+                'meme_url': meme_url,
+                'explanation': explanation
+            })
+            report_stage('saved')
+            return meme_url, meme_id, doc_id, None
+        except Exception as e:
+            error_msg = f"Error storing meme in Firebase: {str(e)}"
             logger.error(error_msg)
             return None, None, None, error_msg
 
@@ -317,50 +1621,622 @@ def generate_meme(thought, location_label, meme_id=None, previous_doc_id=None, e
         logger.error(error_msg)
         return None, None, None, error_msg
 
+def generation_cache_key(thought, location_label, excluded_memes):
+    normalized = json.dumps([
+        ' '.join(thought.lower().split()),
+        ' '.join(location_label.lower().split()),
+        sorted(set(excluded_memes or ()))
+    ])
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+def generate_meme_cached(thought, location_label, excluded_memes=None, user_data=None, on_stage=None, looked_up=False):
+    """
+    generate_meme with a result cache. Identical requests within
+    GENERATION_CACHE_TTL get the same meme back, and identical requests that
+    arrive while one is running wait for it instead of starting their own.
+    Errors are returned to everyone waiting but are not cached. Callers that
+    already checked get_cached_generation pass looked_up=True so the cache
+    lookup is not repeated and counted twice.
+    """
+    key = generation_cache_key(thought, location_label, excluded_memes)
+    cached = None if looked_up else generation_cache.get(key)
+    with generation_cache_lock:
+        # A run that finished since the lookup above is only in the local tier so far
+        cached = cached or generation_cache.peek_local(key)
+        if cached:
+            generation_cache_stats['hits'] += 1
+            if on_stage:
+                on_stage('cached')
+            return tuple(cached)
+        flight = generation_inflight.get(key)
+        leader = flight is None
+        if leader:
+            flight = {'done': threading.Event(), 'result': None}
+            generation_inflight[key] = flight
+            generation_cache_stats['misses'] += 1
+        else:
+            generation_cache_stats['shared'] += 1
+
+    if not leader:
+        flight['done'].wait()
+        if on_stage:
+            on_stage('cached')
+        return flight['result']
+
+    result = (None, None, None, "Error in generate_meme: generation did not complete")
+    try:
+        with timed_stage('generate_total'):
+            result = generate_meme(thought, location_label, excluded_memes=excluded_memes, user_data=user_data, on_stage=on_stage)
+    finally:
+        if result[3] is None:
+            generation_cache.set(key, list(result))
+        with generation_cache_lock:
+            del generation_inflight[key]
+        flight['result'] = result
+        flight['done'].set()
+    return result
+
+def get_cached_generation(thought, location_label, excluded_memes=None):
+    # A finished result for this exact request, without starting a generation
+    cached = generation_cache.get(generation_cache_key(thought, location_label, excluded_memes))
+    return tuple(cached) if cached else None
+
+def get_client_bucket(client_ip):
+    with client_buckets_lock:
+        bucket = client_buckets.get(client_ip)
+        if bucket is None:
+            bucket = TokenBucket(RATE_LIMIT_PER_IP, RATE_LIMIT_PER_IP_BURST)
+            client_buckets[client_ip] = bucket
+        return bucket
+
+def get_batch_client_bucket(client_ip):
+    with batch_client_buckets_lock:
+        bucket = batch_client_buckets.get(client_ip)
+        if bucket is None:
+            bucket = TokenBucket(BATCH_RATE_PER_IP, BATCH_RATE_PER_IP_BURST)
+            batch_client_buckets[client_ip] = bucket
+        return bucket
+
+def admit_generation(client_ip, cost=1):
+    """
+    Charges a generation request to the client's and the global token
+    buckets. Returns (admitted, seconds after which a retry may succeed).
+    """
+    client_bucket = get_client_bucket(client_ip) if RATE_LIMIT_PER_IP > 0 else None
+    if client_bucket:
+        admitted, retry_after = client_bucket.try_acquire(cost)
+        if not admitted:
+            increment_counter('meme_admission_rejections_total', reason='client_rate')
+            return False, retry_after
+    if RATE_LIMIT_GLOBAL > 0:
+        admitted, retry_after = global_generation_bucket.try_acquire(cost)
+        if not admitted:
+            if client_bucket:
+                client_bucket.release(cost)
+            increment_counter('meme_admission_rejections_total', reason='global_rate')
+            return False, retry_after
+    return True, 0.0
+
+def generation_upstream_retry_after():
+    """
+    Seconds until every upstream a generation needs has a closed or
+    half-open circuit again; 0 when they can all be called now.
+    """
+    upstreams = ['openai'] if 'local' in CAPTION_BACKENDS else ['openai', 'imgflip']
+    retry_after = 0.0
+    with http_lock:
+        for upstream in upstreams:
+            opened_at = circuit_state[upstream]['opened_at']
+            if opened_at is not None:
+                retry_after = max(retry_after, CIRCUIT_BREAKER_RESET - (time.time() - opened_at))
+    return retry_after
+
+@contextmanager
+def generation_slot(timeout):
+    """
+    Holds one of GENERATION_MAX_INFLIGHT generation slots, yielding whether
+    one was acquired. With a timeout, gives up at once when
+    GENERATION_MAX_WAITING requests are already waiting; without one (async
+    jobs and batch items, which their own pools bound) waits as long as needed.
+    """
+    acquired = generation_slots.acquire(blocking=False)
+    if not acquired and timeout is None:
+        acquired = generation_slots.acquire()
+    elif not acquired:
+        with admission_lock:
+            queue_full = admission_state['waiting'] >= GENERATION_MAX_WAITING
+            if not queue_full:
+                admission_state['waiting'] += 1
+        if not queue_full:
+            try:
+                acquired = generation_slots.acquire(timeout=timeout)
+            finally:
+                with admission_lock:
+                    admission_state['waiting'] -= 1
+        if not acquired:
+            increment_counter('meme_admission_rejections_total', reason='queue_full' if queue_full else 'queue_timeout')
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            generation_slots.release()
+
+def reject_generation(message, retry_after, status_code=429):
+    """
+    Fast rejection with Retry-After, carrying a few recent memes so the
+    client still has something to show. Only a location already stored for
+    the visitor and feeds already built are used (falling back to the global
+    feed), so rejecting never calls ipapi or Firestore.
+    """
+    try:
+        user_data = get_stored_user_location()
+        feed = peek_gallery_feed(user_data['city'], user_data['region'], user_data['country']) if user_data else None
+        if feed is None:
+            with gallery_feeds_lock:
+                feed = gallery_feeds.get(('global', None))
+        recent = feed['memes'][:ADMISSION_FALLBACK_MEMES] if feed else []
+    except Exception as e:
+        logger.error(f"Error loading fallback memes: {str(e)}")
+        recent = []
+    response = jsonify({
+        'status': message,
+        'meme_html': None,
+        'retry_after': math.ceil(retry_after),
+        'recent_memes': [{'meme_url': meme['meme_url'], 'thought': meme['thought'], 'location': meme.get('location', '')} for meme in recent]
+    })
+    response.status_code = status_code
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+def check_admission(charge=True):
+    # Returns a rejection response, or None when the request may go ahead.
+    # With charge=False only upstream availability is checked.
+    upstream_wait = generation_upstream_retry_after()
+    if upstream_wait > 0:
+        increment_counter('meme_admission_rejections_total', reason='upstream_unavailable')
+        return reject_generation('Meme generation is temporarily unavailable. Here are some recent memes instead.', upstream_wait, 503)
+    if not charge:
+        return None
+    admitted, retry_after = admit_generation(get_client_ip())
+    if not admitted:
+        return reject_generation('You are generating memes too quickly. Please try again shortly.', retry_after)
+    return None
+
 def regenerate_meme(thought, location, excluded_memes):
-    meme_url, meme_id, doc_id, error = generate_meme(thought, location, excluded_memes=excluded_memes)
+    meme_url, meme_id, doc_id, error = generate_meme_cached(thought, location, excluded_memes=excluded_memes)
     if error:
         return error, None, get_memes_from_firebase()
 
-    meme_html = f"""
+    meme_html = render_meme_html(meme_url, thought, location)
+    return "Meme regenerated successfully.", meme_html, get_memes_from_firebase(), meme_id
+
+def run_batch_item(item, all_memes, memes_by_id, client_ip):
+    # Each item is charged to the client's batch budget
+    client_bucket = get_batch_client_bucket(client_ip) if BATCH_RATE_PER_IP > 0 else None
+    if client_bucket and not client_bucket.acquire(1, timeout=BATCH_RATE_WAIT):
+        increment_counter('meme_admission_rejections_total', reason='batch_client_rate')
+        return None, None, None, "Batch rate limit reached. Please retry this item later."
+    # One OpenAI request per item in single-call mode, two in two-step mode
+    openai_requests = 2 if GENERATION_MODE == 'two_step' else 1
+    if not batch_openai_budget.acquire(openai_requests, timeout=BATCH_RATE_WAIT):
+        return None, None, None, "OpenAI rate-limit budget exhausted. Please retry this item later."
+    try:
+        with generation_slot(timeout=None):
+            return create_meme(item['thought'], item['location'], all_memes, memes_by_id)
+    except Exception as e:
+        error_msg = f"Error in generate_meme: {str(e)}"
+        logger.error(error_msg)
+        return None, None, None, error_msg
+
+def store_batch(created):
+    """
+    Writes all memes of a batch in one commit. Returns (storage, error) with
+    storage 'saved', 'queued' when the commit failed and PERSIST_ASYNC hands
+    the memes to the persist worker for retries, or 'failed'. Queued memes
+    reach the gallery once the persist worker has stored them.
+    """
+    try:
+        save_memes(created)
+    except Exception as e:
+        error_msg = f"Error storing meme batch in Firebase: {str(e)}"
+        logger.error(error_msg)
+        # The persist worker only runs in long-lived processes; see PERSIST_ASYNC
+        if not PERSIST_ASYNC:
+            return 'failed', error_msg
+        for doc_id, meme in created:
+            queue_meme_write(doc_id, meme)
+        return 'queued', None
+    for doc_id, meme in created:
+        add_meme_to_gallery(dict(meme, id=doc_id, timestamp=datetime.now(timezone.utc)))
+    return 'saved', None
+
+def generate_meme_batch(items, user_data, client_ip):
+    """
+    Generates memes for a list of {'thought', 'location'} items, yielding one
+    result dict per item in completion order and a final summary. The visitor
+    location and template catalog are resolved once for the whole batch, and
+    every meme is stored in a single batched write at the end. Items that
+    can't get client_ip's batch budget within BATCH_RATE_WAIT are reported as
+    errors. If storage fails, the summary has storage 'failed' and the
+    error, and the doc_ids sent with the items do not exist.
+    """
+    with timed_stage('template_catalog'):
+        all_memes, memes_by_id = get_template_catalog()
+
+    executor = ThreadPoolExecutor(max_workers=min(BATCH_CONCURRENCY, len(items)), thread_name_prefix='batch')
+    futures = {executor.submit(run_batch_item, item, all_memes, memes_by_id, client_ip): index for index, item in enumerate(items)}
+    created = []
+    failed = 0
+    try:
+        for future in as_completed(futures):
+            index = futures[future]
+            meme_url, selected_meme, explanation, error = future.result()
+            if error:
+                failed += 1
+                yield {'index': index, 'status': 'error', 'error': error}
+                continue
+
+            doc_id = get_db().collection('memes').document().id
+            created.append((doc_id, {
+                'thought': items[index]['thought'],
+                'location': items[index]['location'],
+                'city': user_data['city'],
+                'region': user_data['region'],
+                'country': user_data['country'],
+                'meme_url': meme_url,
+                'explanation': explanation
+            }))
+            yield {'index': index, 'status': 'ok', 'meme_url': meme_url, 'meme_id': selected_meme['id'], 'doc_id': doc_id}
+    except GeneratorExit:
+        # Client went away; keep what was already paid for
+        executor.shutdown(wait=False, cancel_futures=True)
+        if created:
+            store_batch(created)
+        raise
+
+    executor.shutdown()
+    storage, error = store_batch(created) if created else (None, None)
+    summary = {'status': 'done', 'succeeded': len(created), 'failed': failed, 'storage': storage}
+    if error:
+        summary['error'] = error
+    yield summary
+
+def render_meme_html(meme_url, thought, location):
+    return f"""
     <div style='text-align: center;'>
         <img src='{meme_url}' alt='Meme' style='max-width: 100%; height: auto;'/>
         <p style='font-size: 1.2em; font-weight: bold;'>{thought}</p>
         <p style='font-size: 1em;'>Location: {location}</p>
     </div>
     """
-    return "Meme regenerated successfully.", meme_html, get_memes_from_firebase(), meme_id
 
-def get_memes_from_firebase(city=None, region=None, country=None):
+def update_generation_job(job_id, **changes):
+    with generation_jobs_condition:
+        job = generation_jobs.get(job_id)
+        if job is None:
+            return
+        stage = changes.pop('stage', None)
+        details = changes.pop('details', None) or {}
+        if stage:
+            job['stages'].append(dict(details, stage=stage, at=time.time()))
+        job.update(changes)
+        job['updated_at'] = time.time()
+        generation_jobs_condition.notify_all()
+
+def get_generation_job(job_id):
+    # Returns a copy so callers can serialise it without holding the lock
+    with generation_jobs_condition:
+        job = generation_jobs.get(job_id)
+        return dict(job, stages=list(job['stages'])) if job else None
+
+def run_generation_job(job_id, thought, location, excluded_memes, user_data, include_html=True, looked_up=False):
     try:
-        # Fetch all memes first
-        all_memes = db.collection('memes').order_by('timestamp', direction=firestore.Query.DESCENDING).limit(100).get()
-        
-        # Return a list of dictionaries for easier processing
-        memes = [{'meme_url': meme.to_dict()['meme_url'], 
-                  'thought': meme.to_dict()['thought'], 
-                  'location': meme.to_dict().get('location', ''),
-                  'city': meme.to_dict().get('city', ''),
-                  'region': meme.to_dict().get('region', ''),
-                  'country': meme.to_dict().get('country', '')} 
-                 for meme in all_memes]
-        
-        # Apply filtering in Python if needed
-        filtered_memes = []
-        if city:
-            filtered_memes = [meme for meme in memes if meme.get('city') == city]
-        
-        if not filtered_memes and region:
-            filtered_memes = [meme for meme in memes if meme.get('region') == region]
-        
-        if not filtered_memes and country:
-            filtered_memes = [meme for meme in memes if meme.get('country') == country]
-        
-        # Fallback to all memes if no specific memes found for filters
-        if not filtered_memes:
-            filtered_memes = memes
+        with generation_slot(timeout=None):
+            update_generation_job(job_id, status='running')
+            meme_url, meme_id, doc_id, error = generate_meme_cached(
+                thought, location, excluded_memes=excluded_memes, user_data=user_data,
+                on_stage=lambda stage, **details: update_generation_job(job_id, stage=stage, details=details),
+                looked_up=looked_up
+            )
+    except Exception as e:
+        meme_url, meme_id, doc_id, error = None, None, None, f"Error in generate_meme: {str(e)}"
+
+    if error:
+        update_generation_job(job_id, status='error', error=error)
+    else:
+        result = {'meme_url': meme_url, 'meme_id': meme_id, 'doc_id': doc_id}
+        if include_html:
+            result['meme_html'] = render_meme_html(meme_url, thought, location)
+        update_generation_job(job_id, status='done', result=result)
+
+def submit_generation_job(thought, location, excluded_memes, user_data, include_html=True, looked_up=False):
+    """
+    Queues a generation on the worker pool and returns its job ID, or None
+    when GENERATION_QUEUE_LIMIT jobs are already queued or running.
+    """
+    with generation_jobs_condition:
+        pending = sum(1 for job in generation_jobs.values() if job['status'] in ('queued', 'running'))
+        if pending >= GENERATION_QUEUE_LIMIT:
+            return None
+        job_id = uuid.uuid4().hex
+        generation_jobs[job_id] = {
+            'job_id': job_id,
+            'status': 'queued',
+            'stages': [],
+            'result': None,
+            'error': None,
+            'created_at': time.time(),
+            'updated_at': time.time()
+        }
+    generation_executor.submit(run_generation_job, job_id, thought, location, excluded_memes, user_data, include_html, looked_up)
+    return job_id
+
+def meme_from_document(document):
+    meme_data = document.to_dict()
+    return {'id': document.id,
+            'meme_url': meme_data['meme_url'],
+            'thought': meme_data['thought'],
+            'location': meme_data.get('location', ''),
+            'city': meme_data.get('city', ''),
+            'region': meme_data.get('region', ''),
+            'country': meme_data.get('country', ''),
+            'timestamp': meme_data.get('timestamp')}
+
+def query_memes(level, value, limit, start_after=None):
+    """
+    Runs a filtered, timestamp-ordered memes query in Firestore. Filtered
+    levels rely on the (city|region|country, timestamp desc) composite
+    indexes in firestore.indexes.json.
+    """
+    query = get_db().collection('memes')
+    if level != 'global':
+        query = query.where(level, '==', value)
+    query = query.order_by('timestamp', direction=FIRESTORE_DESCENDING)
+    if start_after is not None:
+        query = query.start_after({'timestamp': start_after})
+    with timed_stage('firestore_gallery_query'):
+        return [meme_from_document(document) for document in query.limit(limit).get()]
+
+def fetch_recent_memes():
+    return query_memes('global', None, GALLERY_SIZE)
 
-        return filtered_memes
+def set_gallery_snapshot(memes, fetched_at):
+    buckets = {'city': {}, 'region': {}, 'country': {}}
+    for meme in memes:
+        for tier, bucket in buckets.items():
+            if meme.get(tier):
+                bucket.setdefault(meme[tier], []).append(meme)
+    with gallery_lock:
+        gallery_snapshot['memes'] = memes
+        gallery_snapshot.update(buckets)
+        gallery_snapshot['fetched_at'] = fetched_at
+
+def get_gallery_snapshot():
+    """
+    Returns the recent-memes snapshot, re-reading it from Firestore once it is
+    older than GALLERY_CACHE_TTL. Only one thread queries Firestore at a time;
+    the others wait for it and share the result.
+    """
+    with gallery_lock:
+        if time.time() - gallery_snapshot['fetched_at'] <= GALLERY_CACHE_TTL:
+            return dict(gallery_snapshot)
+
+    with gallery_refresh_lock:
+        with gallery_lock:
+            if time.time() - gallery_snapshot['fetched_at'] <= GALLERY_CACHE_TTL:
+                return dict(gallery_snapshot)
+        set_gallery_snapshot(fetch_recent_memes(), time.time())
+        logger.debug("Refreshed gallery snapshot from Firebase.")
+
+    with gallery_lock:
+        return dict(gallery_snapshot)
+
+def add_meme_to_gallery(meme):
+    # Newly written memes show up immediately instead of after the next refresh
+    add_meme_to_feeds(meme)
+    with gallery_lock:
+        if not gallery_snapshot['fetched_at']:
+            return
+        memes = [meme] + gallery_snapshot['memes'][:GALLERY_SIZE - 1]
+        fetched_at = gallery_snapshot['fetched_at']
+    set_gallery_snapshot(memes, fetched_at)
+
+def encode_gallery_cursor(level, value, meme):
+    if not isinstance(meme.get('timestamp'), datetime):
+        return None
+    payload = json.dumps({'level': level, 'value': value, 'ts': meme['timestamp'].isoformat()})
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+def decode_gallery_cursor(cursor):
+    # Raises ValueError, KeyError or TypeError for malformed cursors
+    payload = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    if payload['level'] not in LOCATION_TIERS + ('global',):
+        raise ValueError(f"Unknown gallery level {payload['level']}")
+    return payload['level'], payload['value'], datetime.fromisoformat(payload['ts'])
+
+def query_memes_cached(level, value, limit):
+    key = (level, value, limit)
+    with gallery_tier_cache_lock:
+        if key in gallery_tier_cache:
+            return gallery_tier_cache[key]
+    memes = query_memes(level, value, limit)
+    with gallery_tier_cache_lock:
+        gallery_tier_cache[key] = memes
+    return memes
+
+def get_gallery_page(city=None, region=None, country=None, limit=GALLERY_PAGE_SIZE, cursor=None):
+    """
+    Returns (memes, level, next_cursor) for the most specific of city, region
+    and country that has memes, falling back to all memes ('global').
+
+    The first page comes from the recent-memes snapshot when it already holds
+    the most specific tier. Tiers missing from the snapshot are queried in
+    Firestore concurrently, and later pages continue the same level with a
+    start_after(timestamp) query.
+    """
+    if cursor:
+        level, value, start_after = decode_gallery_cursor(cursor)
+        memes = query_memes(level, value, limit, start_after)
+        next_cursor = encode_gallery_cursor(level, value, memes[-1]) if len(memes) == limit else None
+        return memes, level, next_cursor
+
+    snapshot = get_gallery_snapshot()
+    requested = [(tier, value) for tier, value in zip(LOCATION_TIERS, (city, region, country)) if value]
+
+    # Tiers more specific than the first snapshot hit may still have older memes in Firestore
+    missing = []
+    snapshot_hit = None
+    for tier, value in requested:
+        if snapshot[tier].get(value):
+            snapshot_hit = (tier, value)
+            break
+        missing.append((tier, value))
+
+    if missing:
+        futures = [io_executor.submit(query_memes_cached, tier, value, limit) for tier, value in missing]
+        for (tier, value), future in zip(missing, futures):
+            memes = future.result()
+            if memes:
+                next_cursor = encode_gallery_cursor(tier, value, memes[-1]) if len(memes) == limit else None
+                return memes, tier, next_cursor
+
+    if snapshot_hit:
+        level, value = snapshot_hit
+        bucket = snapshot[level][value]
+    else:
+        level, value = 'global', None
+        bucket = snapshot['memes']
+    memes = bucket[:limit]
+    # A full snapshot may have cut off older memes of this level
+    has_more = len(bucket) > limit or len(snapshot['memes']) >= GALLERY_SIZE
+    next_cursor = encode_gallery_cursor(level, value, memes[-1]) if memes and has_more else None
+    return memes, level, next_cursor
+
+def encode_feed_cursor(level, value, meme_id):
+    payload = json.dumps({'level': level, 'value': value, 'id': meme_id})
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+def decode_feed_cursor(cursor):
+    # Raises ValueError, KeyError or TypeError for malformed cursors
+    payload = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    return payload['level'], payload['value'], payload['id']
+
+def compact_gallery_payload(level, value, memes, next_cursor, delta=False, head_id=None):
+    """
+    Gallery page as positional rows (see GALLERY_COMPACT_FIELDS) with each
+    distinct (city, region, country) listed once in 'places' and referenced
+    by index. 'cursor' names the newest meme of the feed and can be sent back
+    as ?since= to get only newer memes.
+    """
+    places = {}
+    rows = []
+    for meme in memes:
+        place = places.setdefault((meme.get('city', ''), meme.get('region', ''), meme.get('country', '')), len(places))
+        timestamp = meme.get('timestamp')
+        rows.append([meme['id'], meme['meme_url'], meme['thought'], meme.get('location', ''), place,
+                     int(timestamp.timestamp()) if isinstance(timestamp, datetime) else None])
+    return {
+        'level': level,
+        'value': value,
+        'fields': GALLERY_COMPACT_FIELDS,
+        'places': [list(place) for place in places],
+        'memes': rows,
+        'delta': delta,
+        'cursor': encode_feed_cursor(level, value, head_id) if head_id else None,
+        'next_cursor': next_cursor
+    }
+
+def peek_gallery_feed(city=None, region=None, country=None):
+    # The feed a visitor location already resolved to, or None if it isn't built
+    with gallery_feeds_lock:
+        route = gallery_feed_routes.get((city, region, country))
+        return gallery_feeds.get(route) if route else None
+
+def get_gallery_feed(city=None, region=None, country=None):
+    """
+    Returns the materialized feed for a visitor location, building it with
+    get_gallery_page on first use. Feeds are shared by every location that
+    resolves to the same level and value.
+    """
+    route_key = (city, region, country)
+    feed = peek_gallery_feed(city, region, country)
+    if feed is not None:
+        return feed
+
+    memes, level, next_cursor = get_gallery_page(city, region, country)
+    value = None if level == 'global' else dict(zip(LOCATION_TIERS, route_key))[level]
+    with gallery_feeds_lock:
+        feed = gallery_feeds.get((level, value))
+        if feed is None:
+            feed = {'level': level, 'value': value, 'memes': list(memes), 'next_cursor': next_cursor, 'pages': {}, 'version': 0}
+            gallery_feeds[(level, value)] = feed
+        gallery_feed_routes[route_key] = (level, value)
+    return feed
+
+def add_meme_to_feeds(meme):
+    with gallery_feeds_lock:
+        for key in [(tier, meme[tier]) for tier in LOCATION_TIERS if meme.get(tier)] + [('global', None)]:
+            feed = gallery_feeds.get(key)
+            if feed is None:
+                continue
+            feed['memes'].insert(0, meme)
+            if len(feed['memes']) > GALLERY_PAGE_SIZE:
+                del feed['memes'][GALLERY_PAGE_SIZE:]
+                feed['next_cursor'] = encode_gallery_cursor(key[0], key[1], feed['memes'][-1])
+            feed['pages'] = {}
+            feed['version'] += 1
+
+        # Visitors who fell back to a wider level may now have memes at a more specific one
+        for route_key in list(gallery_feed_routes.keys()):
+            route = gallery_feed_routes.get(route_key)
+            if route is None:
+                continue
+            more_specific = LOCATION_TIERS[:LOCATION_TIERS.index(route[0])] if route[0] != 'global' else LOCATION_TIERS
+            if any(value and meme.get(tier) == value for tier, value in zip(LOCATION_TIERS, route_key) if tier in more_specific):
+                del gallery_feed_routes[route_key]
+
+def get_feed_page(feed, limit):
+    """
+    Returns the first page of a feed as a dict with its ETag, the meme ids it
+    holds and the serialized (and optionally gzipped) compact JSON body.
+    Pages are cached on the feed until the next write to it.
+    """
+    with gallery_feeds_lock:
+        page = feed['pages'].get(limit)
+        if page is not None:
+            return page
+        version = feed['version']
+        memes = feed['memes'][:limit]
+        next_cursor = feed['next_cursor'] if len(feed['memes']) <= limit else encode_gallery_cursor(feed['level'], feed['value'], memes[-1])
+
+    ids = [meme['id'] for meme in memes]
+    head_id = ids[0] if ids else None
+    payload = compact_gallery_payload(feed['level'], feed['value'], memes, next_cursor, head_id=head_id)
+    body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    # Derived from content, so every instance serving the same memes agrees on it
+    etag = hashlib.sha1(json.dumps([feed['level'], feed['value'], ids, next_cursor]).encode('utf-8')).hexdigest()
+    page = {
+        'etag': etag,
+        'memes': memes,
+        'ids': ids,
+        'next_cursor': next_cursor,
+        'body': body,
+        'gzip': gzip.compress(body) if GALLERY_GZIP and len(body) >= GALLERY_GZIP_MIN_SIZE else None
+    }
+    with gallery_feeds_lock:
+        # A meme added while the page was built makes it stale; serve it once but don't cache it
+        if feed['version'] == version:
+            feed['pages'][limit] = page
+    return page
+
+def get_gallery_memes(city=None, region=None, country=None):
+    memes, level, _ = get_gallery_page(city, region, country)
+    return memes, level
+
+def get_memes_from_firebase(city=None, region=None, country=None):
+    try:
+        memes, _ = get_gallery_memes(city, region, country)
+        return memes
 
     except Exception as e:
         logger.error(f"Error fetching memes from Firebase: {str(e)}")
@@ -384,43 +2260,60 @@ def get_previous_memes():
         logger.error(f"Error in get_previous_memes: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def query_location_labels(level, value):
+    query = get_db().collection('locations')
+    # The unfiltered list has no order_by: locations created before updated_at existed only
+    # have created_at, and Firestore leaves documents missing the ordered field out
+    if level != 'global':
+        query = query.where(level, '==', value)
+    with timed_stage('firestore_location_query'):
+        return [location.to_dict().get('label', 'Unknown Location') for location in query.limit(LOCATION_QUERY_LIMIT).get()]
+
 def get_locations_from_firebase(city=None, region=None, country=None):
     try:
-        location_labels = []
-        
-        # Attempt to fetch locations matching the city
-        if city:
-            locations = db.collection('locations').where('city', '==', city).get()
-            location_labels = [location.to_dict().get('label', 'Unknown Location') for location in locations]
-            if location_labels:
-                logger.debug(f"Locations found for city {city}: {location_labels}")
-        
-        # If no locations found for city, try region
-        if not location_labels and region:
-            locations = db.collection('locations').where('region', '==', region).get()
-            location_labels = [location.to_dict().get('label', 'Unknown Location') for location in locations]
+        # Query the city, region and country tiers at the same time and keep the most specific hit
+        requested = [(tier, value) for tier, value in zip(LOCATION_TIERS, (city, region, country)) if value]
+        futures = [io_executor.submit(query_location_labels, tier, value) for tier, value in requested]
+        for (tier, value), future in zip(requested, futures):
+            # Labels written before location IDs were derived from the label can appear twice
+            location_labels = list(dict.fromkeys(future.result()))
             if location_labels:
-                logger.debug(f"Locations found for region {region}: {location_labels}")
-        
-        # If no locations found for region, try country
-        if not location_labels and country:
-            locations = db.collection('locations').where('country', '==', country).get()
-            location_labels = [location.to_dict().get('label', 'Unknown Location') for location in locations]
-            if location_labels:
-                logger.debug(f"Locations found for country {country}: {location_labels}")
-        
-        # If still no locations found, fetch all locations
-        if not location_labels:
-            locations = db.collection('locations').get()
-            location_labels = [location.to_dict().get('label', 'Unknown Location') for location in locations]
-            logger.debug(f"No locations found for user's location. Fetched all locations: {location_labels}")
+                logger.debug(f"Locations found for {tier} {value}: {location_labels}")
+                return location_labels
 
+        # If no locations found for the user's location, fetch any locations
+        location_labels = list(dict.fromkeys(query_location_labels('global', None)))
+        logger.debug(f"No locations found for user's location. Fetched other locations: {location_labels}")
         return location_labels
     except Exception as e:
         logger.error(f"Error fetching locations from Firebase: {str(e)}")
         return ["Other (specify below)"]
 
 # 4. Route Definitions
+@app.before_request
+def start_trace():
+    g.request_started = time.perf_counter()
+    if request.headers.get(TRACE_HEADER) == '1':
+        g.trace = []
+
+@app.after_request
+def finish_trace(response):
+    if request.endpoint and 'request_started' in g:
+        observe_stage(f"route_{request.endpoint}", time.perf_counter() - g.request_started)
+    if 'trace' in g:
+        # Stages can repeat (e.g. several OpenAI calls), so number them to keep entries distinct
+        response.headers['Server-Timing'] = ', '.join(
+            f"{stage}-{i};dur={seconds * 1000:.1f}" for i, (stage, seconds) in enumerate(g.trace)
+        )
+    return response
+
+@app.after_request
+def remember_user_location(response):
+    user_location = g.pop('user_location_cookie', None)
+    if user_location is not None:
+        response.set_cookie('user_location', json.dumps(user_location), max_age=USER_LOCATION_COOKIE_MAX_AGE, samesite='Lax')
+    return response
+
 @app.route('/')
 def index():
     logger.debug("Rendering main page")
@@ -447,32 +2340,171 @@ def generate_meme_route():
         data = request.json
         location = data.get('location', '').strip()
         thought = data.get('thought', '').strip()
-        excluded_memes = data.get('excluded_memes', [])
+        excluded_memes = data.get('excluded_memes') or []
+        if not isinstance(excluded_memes, list):
+            excluded_memes = []
+        # Template IDs are compared as strings; anything that isn't a plain value is dropped
+        excluded_memes = [str(meme_id) for meme_id in excluded_memes
+                          if isinstance(meme_id, (str, int)) and not isinstance(meme_id, bool)]
+        excluded_memes = excluded_memes[-GENERATION_MAX_EXCLUDED:]
+        # Compact clients render the meme themselves from meme_url
+        include_html = data.get('format') != 'compact'
 
         if not thought or not location:
             return jsonify({'status': 'Please enter both a location and a thought.', 'meme_html': None})
 
-        meme_url, meme_id, doc_id, error = generate_meme(thought, location, excluded_memes=excluded_memes)
+        # Results already in the cache cost nothing, so they skip admission control
+        cached = get_cached_generation(thought, location, excluded_memes)
+        if cached is None:
+            rejection = check_admission()
+            if rejection is not None:
+                return rejection
+
+        if data.get('async') or request.args.get('async') == '1':
+            # Resolve the location here; the worker has no request context
+            user_data = collect_user_ip_and_location()
+            job_id = submit_generation_job(thought, location, excluded_memes, user_data, include_html, looked_up=True)
+            if job_id is None:
+                return reject_generation('Too many memes are being generated right now. Please try again shortly.', GENERATION_ADMISSION_WAIT)
+            return jsonify({
+                'status': 'Meme generation started.',
+                'job_id': job_id,
+                'status_url': url_for('generation_job_route', job_id=job_id)
+            }), 202
+
+        if cached is not None:
+            with generation_cache_lock:
+                generation_cache_stats['hits'] += 1
+            meme_url, meme_id, doc_id, error = cached
+        else:
+            with generation_slot(GENERATION_ADMISSION_WAIT) as acquired:
+                if not acquired:
+                    return reject_generation('Too many memes are being generated right now. Please try again shortly.', GENERATION_ADMISSION_WAIT)
+                meme_url, meme_id, doc_id, error = generate_meme_cached(thought, location, excluded_memes=excluded_memes, looked_up=True)
         if error:
             return jsonify({'status': error, 'meme_html': None})
 
-        meme_html = f"""
-        <div style='text-align: center;'>
-            <img src='{meme_url}' alt='Meme' style='max-width: 100%; height: auto;'/>
-            <p style='font-size: 1.2em; font-weight: bold;'>{thought}</p>
-            <p style='font-size: 1em;'>Location: {location}</p>
-        </div>
-        """
-
-        return jsonify({
+        result = {
             'status': 'Meme generated successfully.',
-            'meme_html': meme_html,
+            'meme_url': meme_url,
             'meme_id': meme_id
-        })
+        }
+        if include_html:
+            result['meme_html'] = render_meme_html(meme_url, thought, location)
+        return jsonify(result)
     except Exception as e:
         logger.error(f"Error in generate_meme_route: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/generate_memes', methods=['POST'])
+def generate_memes_route():
+    try:
+        data = request.json or {}
+        items = data.get('items')
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'Please provide a non-empty list of items.'}), 400
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({'error': f'A batch can contain at most {BATCH_MAX_ITEMS} items.'}), 400
+
+        cleaned_items = []
+        for index, item in enumerate(items):
+            thought = str(item.get('thought', '')).strip() if isinstance(item, dict) else ''
+            location = str(item.get('location', '')).strip() if isinstance(item, dict) else ''
+            if not thought or not location:
+                return jsonify({'error': f'Item {index} needs both a location and a thought.'}), 400
+            cleaned_items.append({'thought': thought, 'location': location})
+
+        # Resolved once here; the stream runs after the request context is gone
+        user_data = collect_user_ip_and_location()
+
+        # Items are charged to the client's batch budget one by one in run_batch_item,
+        # and their OpenAI calls are paced by batch_openai_budget
+        rejection = check_admission(charge=False)
+        if rejection is not None:
+            return rejection
+        client_ip = get_client_ip()
+
+        def stream_results():
+            for result in generate_meme_batch(cleaned_items, user_data, client_ip):
+                yield json.dumps(result) + '\n'
+
+        return Response(stream_with_context(stream_results()), mimetype='application/x-ndjson')
+    except Exception as e:
+        logger.error(f"Error in generate_memes_route: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/generate_meme/<job_id>')
+def generation_job_route(job_id):
+    job = get_generation_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job ID'}), 404
+
+    wants_stream = request.args.get('stream') == '1' or request.accept_mimetypes.best == 'text/event-stream'
+    if not wants_stream:
+        return jsonify(job)
+
+    def stream_job():
+        sent_stages = 0
+        while True:
+            with generation_jobs_condition:
+                generation_jobs_condition.wait_for(
+                    lambda: (generation_jobs.get(job_id) is None
+                             or len(generation_jobs[job_id]['stages']) > sent_stages
+                             or generation_jobs[job_id]['status'] in ('done', 'error')),
+                    timeout=15
+                )
+            current = get_generation_job(job_id)
+            if current is None:
+                yield "event: error\ndata: {\"error\": \"Unknown or expired job ID\"}\n\n"
+                return
+            if current['status'] in ('done', 'error'):
+                for stage in current['stages'][sent_stages:]:
+                    yield f"event: stage\ndata: {json.dumps(stage)}\n\n"
+                yield f"event: {current['status']}\ndata: {json.dumps(current)}\n\n"
+                return
+            if len(current['stages']) == sent_stages:
+                # Comment line keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+            for stage in current['stages'][sent_stages:]:
+                yield f"event: stage\ndata: {json.dumps(stage)}\n\n"
+            sent_stages = len(current['stages'])
+
+    return Response(stream_with_context(stream_job()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/rendered/<filename>')
+def rendered_meme_route(filename):
+    # Rendered files are named by content hash and never change once written
+    response = send_from_directory(RENDER_DIR, filename, max_age=RENDER_CACHE_MAX_AGE)
+    response.headers['Cache-Control'] = f'public, max-age={RENDER_CACHE_MAX_AGE}, immutable'
+    return response
+
+@app.route('/metrics')
+def metrics_route():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+def gallery_feed_response(feed, limit, since):
+    page = get_feed_page(feed, limit)
+    if request.if_none_match.contains_weak(page['etag']):
+        response = Response(status=304)
+    elif since:
+        # Only the memes the client hasn't seen, when its cursor is still inside this page
+        level, value, seen_id = decode_feed_cursor(since)
+        if (level, value) != (feed['level'], feed['value']) or seen_id not in page['ids']:
+            return gallery_feed_response(feed, limit, None)
+        new_memes = page['memes'][:page['ids'].index(seen_id)]
+        head_id = page['ids'][0] if page['ids'] else None
+        response = jsonify(compact_gallery_payload(feed['level'], feed['value'], new_memes, page['next_cursor'], delta=True, head_id=head_id))
+    elif page['gzip'] is not None and 'gzip' in request.accept_encodings:
+        response = Response(page['gzip'], mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(page['body'], mimetype='application/json')
+    response.set_etag(page['etag'], weak=True)
+    # Depends on the visitor's location, so only the browser may keep it, and must revalidate
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
+
 @app.route('/get_previous_memes')
 def get_previous_memes_route():
     try:
@@ -485,24 +2517,43 @@ def get_previous_memes_route():
         country = user_data['country']
         logger.debug(f"User location data: {user_data}")
         
-        # Fetch memes with fallback logic
-        meme_gallery = get_memes_from_firebase(city=city)
-        level = 'city'
-        if not meme_gallery:
-            meme_gallery = get_memes_from_firebase(region=region)
-            level = 'region'
-        if not meme_gallery:
-            meme_gallery = get_memes_from_firebase(country=country)
-            level = 'country'
-        if not meme_gallery:
-            meme_gallery = get_memes_from_firebase()
-            level = 'global'
-        
-        return jsonify({'memes': meme_gallery, 'level': level})
+        limit = min(max(request.args.get('limit', GALLERY_PAGE_SIZE, type=int), 1), GALLERY_PAGE_SIZE)
+        cursor = request.args.get('cursor')
+        compact = request.args.get('format') == 'compact'
+
+        try:
+            # The first page of the compact form comes from the visitor's materialized feed
+            if compact and not cursor:
+                return gallery_feed_response(get_gallery_feed(city, region, country), limit, request.args.get('since'))
+
+            # Fetch memes with city -> region -> country -> global fallback
+            meme_gallery, level, next_cursor = get_gallery_page(city, region, country, limit=limit, cursor=cursor)
+        except (ValueError, KeyError, TypeError):
+            return jsonify({'error': 'Invalid cursor'}), 400
+
+        if compact:
+            _, value, _ = decode_gallery_cursor(cursor)
+            return jsonify(compact_gallery_payload(level, value, meme_gallery, next_cursor))
+        memes = [{key: value for key, value in meme.items() if key != 'timestamp'} for meme in meme_gallery]
+        return jsonify({'memes': memes, 'level': level, 'next_cursor': next_cursor})
     except Exception as e:
         logger.error(f"Error in get_previous_memes: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+# Optional background warm-up so the first real request finds Firestore, the template
+# catalog and the geo-IP database ready
+def warm_up():
+    try:
+        get_db()
+        get_template_catalog()
+        get_geoip_reader()
+        logger.debug("Warm-up finished.")
+    except Exception as e:
+        logger.error(f"Error during warm-up: {str(e)}")
+
+if os.environ.get('WARM_START') == '1':
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
 # 5. App Execution
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
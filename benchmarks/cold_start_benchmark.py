@@ -0,0 +1,85 @@
+"""
+Measures the cold-start cost of the app.
+
+Imports app in fresh interpreters with `python -X importtime` and reports
+the wall time of `import app` plus the modules with the highest cumulative
+import time. With --with-firebase it also times the first get_db() call
+(requires FIREBASE_CREDENTIALS), which is what the first Firestore-backed
+request pays after a cold start.
+
+Usage:
+    python benchmarks/cold_start_benchmark.py [--runs 5] [--top 15] [--with-firebase]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+IMPORT_SNIPPET = "import time; start = time.perf_counter(); import app; print(time.perf_counter() - start)"
+FIREBASE_SNIPPET = "import time, app; start = time.perf_counter(); app.get_db(); print(time.perf_counter() - start)"
+
+
+def run_snippet(snippet, importtime=False):
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-c', snippet]
+    result = subprocess.run(command, cwd=ROOT, capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def parse_importtime(stderr):
+    """
+    Returns {module: cumulative_us} for the modules that app imports directly,
+    plus app itself, from -X importtime output. Children are listed before
+    their parent, one extra level of indentation per nesting level.
+    """
+    modules = {}
+    children = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        if depth == 1:
+            children[name] = int(cumulative_us)
+        elif depth == 0:
+            if name == 'app':
+                modules.update(children)
+                modules['app'] = int(cumulative_us)
+            children = {}
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to average over')
+    parser.add_argument('--top', type=int, default=15, help='modules to list')
+    parser.add_argument('--with-firebase', action='store_true', help='also time the first get_db() call')
+    args = parser.parse_args()
+
+    import_times = []
+    module_times = {}
+    for _ in range(args.runs):
+        elapsed, stderr = run_snippet(IMPORT_SNIPPET, importtime=True)
+        import_times.append(elapsed)
+        for name, cumulative_us in parse_importtime(stderr).items():
+            module_times.setdefault(name, []).append(cumulative_us)
+
+    print(f"import app: median {statistics.median(import_times) * 1000:.1f}ms over {args.runs} runs")
+    print(f"{'cumulative ms':>14}  module")
+    ranked = sorted(module_times.items(), key=lambda item: -statistics.median(item[1]))
+    for name, times in ranked[:args.top]:
+        print(f"{statistics.median(times) / 1000:>14.1f}  {name}")
+
+    if args.with_firebase:
+        firebase_times = [run_snippet(FIREBASE_SNIPPET)[0] for _ in range(args.runs)]
+        print(f"first get_db(): median {statistics.median(firebase_times) * 1000:.1f}ms over {args.runs} runs")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+"""
+Offline load test for the Flask app.
+
+Runs the app on a local server with OpenAI, Imgflip and ipapi replaced by
+local HTTP stubs and Firestore by an in-memory stand-in (see
+upstream_stubs.py), each with its own injected latency and error rate.
+Simulated visitors, each with their own cookies and client IP, then hit
+/, /generate_meme and /get_previous_memes concurrently.
+
+The report covers throughput, p50/p95/p99 latency per endpoint, upstream
+calls per request and mean stage latency from the app's own metrics. It is
+written as JSON (--output) so runs can be diffed or compared with --compare.
+
+Usage:
+    python benchmarks/load_test.py --duration 30 --concurrency 16 \\
+        --openai-latency 0.8 --imgflip-latency 0.3 --error-rate 0.01 \\
+        --output benchmarks/results/my-branch.json --compare benchmarks/results/baseline.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from upstream_stubs import CITIES, CallCounter, InMemoryFirestore, StubUpstreams, UpstreamProfile  # noqa: E402
+
+ENDPOINTS = ('index', 'generate', 'gallery')
+THOUGHTS = [
+    "I can't decide between pizza and tacos",
+    "Still waiting for the bus",
+    "Everything is fine at work",
+    "My code works and I don't know why",
+    "It's 3am and I'm still awake",
+    "Monday again",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=20, help='seconds to generate load for')
+    parser.add_argument('--concurrency', type=int, default=8, help='simulated visitors running at once')
+    parser.add_argument('--mix', default='index=1,generate=1,gallery=3', help='relative endpoint weights')
+    parser.add_argument('--repeat-ratio', type=float, default=0.3, help='share of generations reusing a common thought')
+    for upstream, latency in (('openai', 0.5), ('imgflip', 0.2), ('ipapi', 0.1), ('firestore', 0.03)):
+        parser.add_argument(f'--{upstream}-latency', type=float, default=latency, help=f'mean {upstream} latency in seconds')
+        parser.add_argument(f'--{upstream}-error-rate', type=float, default=None, help=f'{upstream} error rate (defaults to --error-rate)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='error rate for every upstream')
+    parser.add_argument('--openai-stream', action='store_true', help='run the app with OPENAI_STREAM=1')
+    parser.add_argument('--caption-backends', default='imgflip', help='CAPTION_BACKENDS for the app, e.g. local or local,imgflip')
+    parser.add_argument('--gallery-format', choices=('full', 'compact'), default='full',
+                        help='gallery payload; compact also revalidates with since= and If-None-Match like the index page')
+    parser.add_argument('--persist-async', action='store_true',
+                        help='run the app with PERSIST_ASYNC=1 (background meme writes)')
+    parser.add_argument('--rate-limit', action='store_true',
+                        help="keep the app's generation rate limits (off by default so runs compare with the baseline)")
+    parser.add_argument('--seed-memes', type=int, default=300, help='memes preloaded into the Firestore stand-in')
+    parser.add_argument('--label', default='', help='free-form label stored with the results')
+    parser.add_argument('--output', help='write results as JSON to this path')
+    parser.add_argument('--compare', help='previous results JSON to compare against')
+    return parser.parse_args()
+
+
+def configure_environment(base_url, workdir, openai_stream=False, caption_backends='imgflip', rate_limit=False, persist_async=False):
+    # Must happen before app is imported; it reads its settings at import time
+    os.environ.update({
+        'OPENAI_BASE_URL': f'{base_url}/openai/v1',
+        'IMGFLIP_BASE_URL': f'{base_url}/imgflip',
+        'IPAPI_BASE_URL': f'{base_url}/ipapi',
+        'OPENAI_API_KEY': 'stub',
+        'GEOIP_RESOLVERS': 'ipapi',
+        'TEMPLATE_CATALOG_PATH': os.path.join(workdir, 'meme_templates.json'),
+        'PERSIST_SPOOL_DIR': os.path.join(workdir, 'spool'),
+        'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'WARNING'),
+        'OPENAI_STREAM': '1' if openai_stream else '0',
+        'CAPTION_BACKENDS': caption_backends,
+        'PERSIST_ASYNC': '1' if persist_async else '0',
+        'RENDER_DIR': os.path.join(workdir, 'rendered'),
+        'TEMPLATE_IMAGE_DIR': os.path.join(workdir, 'template_images'),
+    })
+    if not rate_limit:
+        os.environ.update({'RATE_LIMIT_PER_IP': '0', 'RATE_LIMIT_GLOBAL': '0'})
+    os.environ.pop('CACHE_REDIS_URL', None)
+    os.environ.pop('CACHE_SNAPSHOT_DIR', None)
+
+
+def seed_firestore(firestore, count):
+    start = datetime.now(timezone.utc) - timedelta(days=1)
+    memes = firestore.collections.setdefault('memes', {})
+    locations = firestore.collections.setdefault('locations', {})
+    for i in range(count):
+        city, region, country = CITIES[i % len(CITIES)]
+        memes[f'seed{i:05d}'] = {
+            'thought': random.choice(THOUGHTS), 'location': f'{city} Cafe', 'city': city, 'region': region,
+            'country': country, 'meme_url': f'https://i.imgflip.test/seed{i}.jpg', 'explanation': 'seed',
+            'timestamp': start + timedelta(seconds=i),
+        }
+    for city, region, country in CITIES:
+        locations[f'{city} Cafe'] = {'label': f'{city} Cafe', 'city': city, 'region': region, 'country': country,
+                                     'updated_at': start}
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+class Visitor:
+    def __init__(self, number, base_url, weights, repeat_ratio, gallery_format='full'):
+        self.base_url = base_url
+        self.weights = weights
+        self.repeat_ratio = repeat_ratio
+        self.gallery_format = gallery_format
+        self.gallery_cursor = None
+        self.gallery_etag = None
+        self.session = requests.Session()
+        self.session.headers['X-Forwarded-For'] = f'8.{number // 250 % 250}.{number % 250}.{random.randint(1, 250)}'
+        self.city = CITIES[number % len(CITIES)][0]
+
+    def request(self, endpoint):
+        if endpoint == 'index':
+            response = self.session.get(f'{self.base_url}/', timeout=60)
+            return response.status_code == 200
+        if endpoint == 'gallery' and self.gallery_format == 'compact':
+            params = {'format': 'compact', 'since': self.gallery_cursor} if self.gallery_cursor else {'format': 'compact'}
+            headers = {'If-None-Match': self.gallery_etag} if self.gallery_etag else {}
+            response = self.session.get(f'{self.base_url}/get_previous_memes', params=params, headers=headers, timeout=60)
+            if response.status_code == 304:
+                return True
+            self.gallery_cursor = response.json().get('cursor')
+            self.gallery_etag = response.headers.get('ETag')
+            return response.status_code == 200 and 'memes' in response.json()
+        if endpoint == 'gallery':
+            response = self.session.get(f'{self.base_url}/get_previous_memes', timeout=60)
+            return response.status_code == 200 and 'memes' in response.json()
+        if random.random() < self.repeat_ratio:
+            thought = random.choice(THOUGHTS)
+        else:
+            thought = f'{random.choice(THOUGHTS)} #{random.getrandbits(32)}'
+        response = self.session.post(f'{self.base_url}/generate_meme', json={'thought': thought, 'location': f'{self.city} Cafe'}, timeout=60)
+        return response.status_code == 200 and response.json().get('status') == 'Meme generated successfully.'
+
+    def run(self, deadline, samples, lock):
+        endpoints = list(self.weights)
+        weights = [self.weights[endpoint] for endpoint in endpoints]
+        while time.time() < deadline:
+            endpoint = random.choices(endpoints, weights)[0]
+            start = time.perf_counter()
+            try:
+                ok = self.request(endpoint)
+            except (requests.RequestException, ValueError):
+                ok = False
+            with lock:
+                samples.append((endpoint, time.perf_counter() - start, ok))
+
+
+def summarize(samples, elapsed, calls, app):
+    results = {'endpoints': {}}
+    for endpoint in ENDPOINTS + ('total',):
+        selected = [sample for sample in samples if endpoint == 'total' or sample[0] == endpoint]
+        latencies = [latency * 1000 for _, latency, _ in selected]
+        results['endpoints'][endpoint] = {
+            'requests': len(selected),
+            'errors': sum(1 for _, _, ok in selected if not ok),
+            'throughput_rps': round(len(selected) / elapsed, 2),
+            'p50_ms': round(percentile(latencies, 50), 1) if latencies else None,
+            'p95_ms': round(percentile(latencies, 95), 1) if latencies else None,
+            'p99_ms': round(percentile(latencies, 99), 1) if latencies else None,
+        }
+    results['upstream_calls'] = calls
+    results['upstream_calls_per_request'] = {name: round(count / max(len(samples), 1), 3) for name, count in sorted(calls.items())}
+    with app.metrics_lock:
+        results['stage_mean_ms'] = {
+            stage: round(histogram['sum'] / histogram['count'] * 1000, 1)
+            for stage, histogram in sorted(app.stage_histograms.items()) if histogram['count']
+        }
+    return results
+
+
+def print_report(results, previous=None):
+    if previous:
+        # Runs of different lengths compare fine; anything else changes what is measured
+        config = {key: value for key, value in results['config'].items() if key != 'duration'}
+        previous_config = {key: value for key, value in previous.get('config', {}).items() if key != 'duration'}
+        differences = [f"{key}={previous_config.get(key)!r}->{config.get(key)!r}"
+                       for key in sorted(set(config) | set(previous_config)) if config.get(key) != previous_config.get(key)]
+        if differences:
+            print('warning: comparing runs with different settings: ' + ', '.join(differences))
+    print(f"{'endpoint':<10} {'requests':>8} {'errors':>6} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for endpoint, stats in results['endpoints'].items():
+        line = f"{endpoint:<10} {stats['requests']:>8} {stats['errors']:>6} {stats['throughput_rps']:>8}"
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            line += f" {stats[key] if stats[key] is not None else '-':>9}"
+        print(line)
+        if previous and endpoint in previous['endpoints']:
+            old = previous['endpoints'][endpoint]
+            deltas = []
+            for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+                if stats[key] is not None and old.get(key):
+                    deltas.append(f"{key} {100 * (stats[key] - old[key]) / old[key]:+.0f}%")
+            print(f"{'':<10} vs previous: {', '.join(deltas) or 'n/a'}")
+    print('upstream calls per request: ' + ', '.join(f'{name}={value}' for name, value in results['upstream_calls_per_request'].items()))
+
+
+def main():
+    args = parse_args()
+    weights = {name: float(weight) for name, weight in (item.split('=') for item in args.mix.split(','))}
+    unknown = set(weights) - set(ENDPOINTS)
+    if unknown:
+        sys.exit(f"Unknown endpoints in --mix: {', '.join(sorted(unknown))}")
+
+    profiles = {}
+    for upstream in ('openai', 'imgflip', 'ipapi', 'firestore'):
+        error_rate = getattr(args, f'{upstream}_error_rate')
+        profiles[upstream] = UpstreamProfile(getattr(args, f'{upstream}_latency'), args.error_rate if error_rate is None else error_rate)
+
+    counter = CallCounter()
+    stubs = StubUpstreams(profiles, counter).start()
+    workdir = tempfile.mkdtemp(prefix='meme-load-test-')
+    configure_environment(stubs.base_url, workdir, args.openai_stream, args.caption_backends, args.rate_limit, args.persist_async)
+
+    import app
+    from werkzeug.serving import make_server
+
+    firestore = InMemoryFirestore(profiles['firestore'], counter)
+    seed_firestore(firestore, args.seed_memes)
+    app.firestore_client['db'] = firestore
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+
+    samples = []
+    lock = threading.Lock()
+    start = time.time()
+    deadline = start + args.duration
+    visitors = [Visitor(i, base_url, weights, args.repeat_ratio, args.gallery_format) for i in range(args.concurrency)]
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for visitor in visitors:
+            executor.submit(visitor.run, deadline, samples, lock)
+    elapsed = time.time() - start
+
+    server.shutdown()
+    stubs.stop()
+
+    results = {
+        'label': args.label,
+        'recorded_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'config': {
+            'duration': args.duration,
+            'concurrency': args.concurrency,
+            'mix': weights,
+            'repeat_ratio': args.repeat_ratio,
+            'openai_stream': args.openai_stream,
+            'caption_backends': args.caption_backends,
+            'gallery_format': args.gallery_format,
+            'rate_limit': args.rate_limit,
+            'persist_async': args.persist_async,
+            'seed_memes': args.seed_memes,
+            'upstreams': {name: {'latency': profile.latency, 'error_rate': profile.error_rate} for name, profile in profiles.items()},
+        },
+    }
+    results.update(summarize(samples, elapsed, counter.snapshot(), app))
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_report(results, previous)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Compares the full-catalog selection prompt against the shortlisted prompt.
+
+Reports prompt tokens and local ranking time for each sample thought. With
+--live it also sends both prompts to OpenAI and reports the selection latency
+(requires OPENAI_API_KEY and costs a few requests per thought).
+
+Usage:
+    python benchmarks/shortlist_benchmark.py [--k 20] [--live] [--mode single|two_step]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: E402
+
+SAMPLE_THOUGHTS = [
+    "I can't decide between pizza and tacos for lunch",
+    "Still waiting for the bus after forty minutes",
+    "Everything is fine at work, totally fine",
+    "My code works and I have no idea why",
+    "Told myself I'd go to bed early, it's 3am",
+    "The coffee machine broke on a Monday",
+    "Finally finished my taxes",
+    "Why does the wifi only work in the hallway",
+]
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding('cl100k_base')
+
+    def count_tokens(messages):
+        return sum(len(_encoding.encode(message['content'])) + 4 for message in messages)
+except ImportError:
+    def count_tokens(messages):
+        # Rough approximation when tiktoken is not installed
+        return sum(len(message['content']) // 4 + 4 for message in messages)
+
+
+def build_messages(mode, thought, meme_list):
+    if mode == 'two_step':
+        return app.build_selection_messages(thought, 'Benchmark City', meme_list)
+    return app.build_single_call_messages(thought, 'Benchmark City', meme_list)
+
+
+def timed_completion(mode, messages):
+    data = {"model": app.OPENAI_MODEL, "temperature": .9, "messages": messages}
+    if mode != 'two_step':
+        data["response_format"] = {"type": "json_object"}
+    start = time.perf_counter()
+    response = app.call_openai_api(data)
+    elapsed = time.perf_counter() - start
+    return elapsed if response is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--k', type=int, default=app.TEMPLATE_SHORTLIST_SIZE, help='shortlist size')
+    parser.add_argument('--mode', choices=['single', 'two_step'], default=app.GENERATION_MODE)
+    parser.add_argument('--live', action='store_true', help='also time real OpenAI selection calls')
+    args = parser.parse_args()
+
+    meme_list = app.get_meme_list()
+    if not meme_list:
+        sys.exit("Template catalog is empty; check Imgflip access or TEMPLATE_CATALOG_PATH.")
+
+    rows = []
+    for thought in SAMPLE_THOUGHTS:
+        start = time.perf_counter()
+        shortlist = app.shortlist_templates(thought, meme_list, args.k)
+        rank_ms = (time.perf_counter() - start) * 1000
+
+        full_messages = build_messages(args.mode, thought, meme_list)
+        short_messages = build_messages(args.mode, thought, shortlist)
+        row = {
+            'thought': thought,
+            'full_tokens': count_tokens(full_messages),
+            'short_tokens': count_tokens(short_messages),
+            'rank_ms': rank_ms,
+        }
+        if args.live:
+            row['full_s'] = timed_completion(args.mode, full_messages)
+            row['short_s'] = timed_completion(args.mode, short_messages)
+        rows.append(row)
+
+    print(f"catalog={len(meme_list)} templates  k={args.k}  mode={args.mode}")
+    for row in rows:
+        line = f"{row['full_tokens']:>6} -> {row['short_tokens']:>5} tokens  rank {row['rank_ms']:.2f}ms"
+        if args.live:
+            full_s = f"{row['full_s']:.2f}s" if row['full_s'] is not None else 'error'
+            short_s = f"{row['short_s']:.2f}s" if row['short_s'] is not None else 'error'
+            line += f"  latency {full_s} -> {short_s}"
+        print(f"{line}  {row['thought']}")
+
+    full_tokens = statistics.mean(row['full_tokens'] for row in rows)
+    short_tokens = statistics.mean(row['short_tokens'] for row in rows)
+    print(f"mean prompt tokens: {full_tokens:.0f} -> {short_tokens:.0f} ({100 * (1 - short_tokens / full_tokens):.0f}% fewer)")
+    print(f"mean ranking time: {statistics.mean(row['rank_ms'] for row in rows):.2f}ms")
+    if args.live:
+        full_times = [row['full_s'] for row in rows if row['full_s'] is not None]
+        short_times = [row['short_s'] for row in rows if row['short_s'] is not None]
+        if full_times and short_times:
+            print(f"median selection latency: {statistics.median(full_times):.2f}s -> {statistics.median(short_times):.2f}s")
+
+
+if __name__ == '__main__':
+    main()
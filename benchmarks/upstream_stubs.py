@@ -0,0 +1,313 @@
+"""
+Local stand-ins for the app's four upstreams, used by the load-test harness.
+
+StubUpstreams serves OpenAI chat completions (plain or streamed), Imgflip
+get_memes/caption_image and template images, and ipapi lookups over HTTP on
+localhost. InMemoryFirestore implements the
+part of the Firestore client API the app uses. Both inject a configurable
+latency and error rate per upstream and count calls.
+"""
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+CITIES = [
+    ('Paris', 'Ile-de-France', 'France'),
+    ('Lyon', 'Auvergne-Rhone-Alpes', 'France'),
+    ('Berlin', 'Land Berlin', 'Germany'),
+    ('Austin', 'Texas', 'United States'),
+    ('Dallas', 'Texas', 'United States'),
+    ('Toronto', 'Ontario', 'Canada'),
+]
+
+TEMPLATES = [{'id': str(100000 + i), 'name': f'Template {i}', 'box_count': 2 + (i % 3 == 0)} for i in range(100)]
+
+
+class UpstreamProfile:
+    """Latency (seconds, uniform in [latency * 0.5, latency * 1.5]) and error rate for one upstream."""
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+
+    def delay(self):
+        if self.latency:
+            time.sleep(random.uniform(self.latency * 0.5, self.latency * 1.5))
+
+    def should_fail(self):
+        return random.random() < self.error_rate
+
+
+class CallCounter:
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+def completion(content, prompt):
+    return {
+        'choices': [{'message': {'role': 'assistant', 'content': content}}],
+        'usage': {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(content) // 4},
+    }
+
+
+def fake_openai_reply(data):
+    prompt = data['messages'][-1]['content']
+    templates = {template['id']: template for template in TEMPLATES}
+    if 'text boxes (from text0' in prompt:
+        box_count = int(re.search(r'requires (\d+) text boxes', prompt).group(1))
+        return completion('\n'.join(f'text{i}: caption {i}' for i in range(box_count)), prompt)
+
+    offered = re.findall(r'\(ID: (\d+),', prompt)
+    meme_id = offered[0] if offered else TEMPLATES[0]['id']
+    if data.get('response_format', {}).get('type') == 'json_object':
+        texts = [f'caption {i}' for i in range(templates[meme_id]['box_count'])]
+        content = json.dumps({'meme': templates[meme_id]['name'], 'meme_id': meme_id, 'explanation': 'stub', 'texts': texts})
+    else:
+        content = f"meme: {templates[meme_id]['name']}\nmeme_id: {meme_id}\nexplanation: stub"
+    return completion(content, prompt)
+
+
+def template_image(template_id):
+    # Flat-colour PNG standing in for a template's base image (needs Pillow)
+    from io import BytesIO
+    from PIL import Image
+    colour = tuple(int(hashlib.md5(template_id.encode()).hexdigest()[i:i + 2], 16) for i in (0, 2, 4))
+    output = BytesIO()
+    Image.new('RGB', (500, 400), colour).save(output, 'PNG')
+    return output.getvalue()
+
+
+def stream_events(reply, chunk_size=16):
+    # Server-sent events as OpenAI sends them for stream: true, usage in the last chunk
+    content = reply['choices'][0]['message']['content']
+    events = [{'choices': [{'index': 0, 'delta': {'content': content[i:i + chunk_size]}}]} for i in range(0, len(content), chunk_size)]
+    events.append({'choices': [], 'usage': reply['usage']})
+    return ''.join(f'data: {json.dumps(event)}\n\n' for event in events) + 'data: [DONE]\n\n'
+
+
+class StubUpstreams:
+    """
+    HTTP stand-ins mounted under /openai, /imgflip and /ipapi on one local
+    server. profiles maps 'openai', 'imgflip' and 'ipapi' to UpstreamProfile.
+    """
+
+    def __init__(self, profiles, counter):
+        self.profiles = profiles
+        self.counter = counter
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def make_handler(self):
+        stubs = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status, payload, content_type='application/json'):
+                if isinstance(payload, bytes):
+                    body = payload
+                else:
+                    body = (payload if isinstance(payload, str) else json.dumps(payload)).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def handle_upstream(self, method):
+                upstream = self.path.split('/')[1]
+                profile = stubs.profiles.get(upstream)
+                if profile is None:
+                    return self.send_json(404, {'error': 'unknown upstream'})
+
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode() if length else ''
+                stubs.counter.add(upstream)
+                profile.delay()
+                if profile.should_fail():
+                    return self.send_json(503, {'error': 'injected failure'})
+
+                path = self.path[len(upstream) + 1:]
+                if upstream == 'openai' and method == 'POST':
+                    data = json.loads(body)
+                    if data.get('stream'):
+                        return self.send_json(200, stream_events(fake_openai_reply(data)), 'text/event-stream')
+                    return self.send_json(200, fake_openai_reply(data))
+                if upstream == 'imgflip' and path == '/get_memes':
+                    memes = [dict(template, url=f"{stubs.base_url}/imgflip/templates/{template['id']}.png") for template in TEMPLATES]
+                    return self.send_json(200, {'success': True, 'data': {'memes': memes}})
+                if upstream == 'imgflip' and path.startswith('/templates/'):
+                    return self.send_json(200, template_image(path.rsplit('/', 1)[1].split('.')[0]), 'image/png')
+                if upstream == 'imgflip' and path == '/caption_image':
+                    template_id = parse_qs(body).get('template_id', ['0'])[0]
+                    return self.send_json(200, {'success': True, 'data': {'url': f'https://i.imgflip.test/{template_id}-{random.getrandbits(32):08x}.jpg'}})
+                if upstream == 'ipapi':
+                    ip_address = path.strip('/').split('/')[0]
+                    city, region, country = CITIES[int(hashlib.md5(ip_address.encode()).hexdigest(), 16) % len(CITIES)]
+                    return self.send_json(200, {'ip': ip_address, 'city': city, 'region': region, 'country_name': country})
+                return self.send_json(404, {'error': 'not found'})
+
+            def do_GET(self):
+                self.handle_upstream('GET')
+
+            def do_POST(self):
+                self.handle_upstream('POST')
+
+        return Handler
+
+
+class InjectedFirestoreError(Exception):
+    pass
+
+
+class StubDocument:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class StubDocumentRef:
+    def __init__(self, store, collection, doc_id):
+        self.store = store
+        self.collection = collection
+        self.id = doc_id
+
+
+class StubQuery:
+    def __init__(self, store, collection, filters=(), order=None, cursor=None, limit=None):
+        self.store = store
+        self.collection = collection
+        self.filters = tuple(filters)
+        self.order = order
+        self.cursor = cursor
+        self.max_results = limit
+
+    def copy(self, **changes):
+        state = dict(filters=self.filters, order=self.order, cursor=self.cursor, limit=self.max_results)
+        state.update(changes)
+        return StubQuery(self.store, self.collection, **state)
+
+    def where(self, field, op, value):
+        return self.copy(filters=self.filters + ((field, value),))
+
+    def order_by(self, field, direction='ASCENDING'):
+        return self.copy(order=(field, direction))
+
+    def start_after(self, values):
+        return self.copy(cursor=values)
+
+    def limit(self, count):
+        return self.copy(limit=count)
+
+    def get(self):
+        return self.store.run_query(self)
+
+    stream = get
+
+
+class StubCollection(StubQuery):
+    def document(self, doc_id=None):
+        return StubDocumentRef(self.store, self.collection, doc_id or self.store.new_id())
+
+
+class StubBatch:
+    def __init__(self, store):
+        self.store = store
+        self.writes = []
+
+    def set(self, ref, data, merge=False):
+        self.writes.append((ref, data, merge))
+
+    def commit(self):
+        self.store.commit(self.writes)
+
+
+class InMemoryFirestore:
+    """
+    Enough of the Firestore client for the app: collection/document refs,
+    where/order_by/start_after/limit queries and batched set(merge=) writes.
+    Reads and commits are counted under 'firestore_read' and 'firestore_commit'.
+    """
+
+    def __init__(self, profile, counter):
+        self.profile = profile
+        self.counter = counter
+        self.collections = {}
+        self.lock = threading.Lock()
+
+    def new_id(self):
+        return f'{random.getrandbits(80):020x}'
+
+    def collection(self, name):
+        return StubCollection(self, name)
+
+    def batch(self):
+        return StubBatch(self)
+
+    def call(self, kind):
+        self.counter.add(kind)
+        self.profile.delay()
+        if self.profile.should_fail():
+            raise InjectedFirestoreError(f'injected {kind} failure')
+
+    def resolve(self, value):
+        from firebase_admin import firestore
+        return datetime.now(timezone.utc) if value is firestore.SERVER_TIMESTAMP else value
+
+    def commit(self, writes):
+        self.call('firestore_commit')
+        with self.lock:
+            for ref, data, merge in writes:
+                documents = self.collections.setdefault(ref.collection, {})
+                data = {key: self.resolve(value) for key, value in data.items()}
+                documents[ref.id] = dict(documents.get(ref.id, {}), **data) if merge else data
+
+    def run_query(self, query):
+        self.call('firestore_read')
+        with self.lock:
+            documents = [StubDocument(doc_id, data) for doc_id, data in self.collections.get(query.collection, {}).items()]
+        documents = [document for document in documents if all(document._data.get(field) == value for field, value in query.filters)]
+        if query.order:
+            field, direction = query.order
+            documents = [document for document in documents if field in document._data]
+            documents.sort(key=lambda document: document._data[field], reverse=direction == 'DESCENDING')
+            if query.cursor is not None:
+                bound = query.cursor[field]
+                if direction == 'DESCENDING':
+                    documents = [document for document in documents if document._data[field] < bound]
+                else:
+                    documents = [document for document in documents if document._data[field] > bound]
+        return documents[:query.max_results] if query.max_results else documents
@@ -0,0 +1,89 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+# app reads its settings at import time. No geo-IP resolvers and no shared cache, so
+# nothing here reaches the network; rate limits are switched on per test
+WORKDIR = tempfile.mkdtemp(prefix='meme-tests-')
+os.environ.update({
+    'GEOIP_RESOLVERS': '',
+    'RATE_LIMIT_PER_IP': '0',
+    'RATE_LIMIT_GLOBAL': '0',
+    'PERSIST_ASYNC': '0',
+    'TEMPLATE_CATALOG_PATH': os.path.join(WORKDIR, 'meme_templates.json'),
+    'PERSIST_SPOOL_DIR': os.path.join(WORKDIR, 'spool'),
+    'RENDER_DIR': os.path.join(WORKDIR, 'rendered'),
+    'TEMPLATE_IMAGE_DIR': os.path.join(WORKDIR, 'template_images'),
+    'LOG_LEVEL': 'WARNING',
+})
+os.environ.pop('CACHE_REDIS_URL', None)
+os.environ.pop('CACHE_SNAPSHOT_DIR', None)
+
+import pytest  # noqa: E402
+from cachetools import TTLCache  # noqa: E402
+
+import app as meme_app  # noqa: E402
+from upstream_stubs import CallCounter, InMemoryFirestore, UpstreamProfile  # noqa: E402
+
+
+class FakeRedis:
+    """
+    Dict-backed stand-in for the shared cache tier. Set fail to make every
+    call raise like an unreachable server.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.calls = 0
+        self.fail = False
+
+    def call(self):
+        self.calls += 1
+        if self.fail:
+            raise ConnectionError('shared cache down')
+
+    def get(self, key):
+        self.call()
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.call()
+        self.data[key] = value
+
+    def delete(self, key):
+        self.call()
+        self.data.pop(key, None)
+
+
+@pytest.fixture
+def app(monkeypatch):
+    """The app module with fresh gallery, cache and admission state."""
+    monkeypatch.setattr(meme_app, 'gallery_snapshot', {'memes': [], 'city': {}, 'region': {}, 'country': {}, 'fetched_at': 0.0})
+    monkeypatch.setattr(meme_app, 'gallery_tier_cache', TTLCache(maxsize=1000, ttl=60))
+    monkeypatch.setattr(meme_app, 'gallery_feeds', TTLCache(maxsize=1000, ttl=60))
+    monkeypatch.setattr(meme_app, 'gallery_feed_routes', TTLCache(maxsize=1000, ttl=60))
+    monkeypatch.setattr(meme_app, 'shared_cache', {'client': None, 'loaded': True, 'failed_at': None})
+    monkeypatch.setattr(meme_app, 'generation_cache', meme_app.TieredCache('generation', maxsize=100, ttl=60))
+    monkeypatch.setattr(meme_app, 'generation_inflight', {})
+    monkeypatch.setattr(meme_app, 'generation_cache_stats', {'hits': 0, 'misses': 0, 'shared': 0})
+    monkeypatch.setattr(meme_app, 'client_buckets', TTLCache(maxsize=1000, ttl=3600))
+    monkeypatch.setattr(meme_app, 'batch_client_buckets', TTLCache(maxsize=1000, ttl=3600))
+    return meme_app
+
+
+@pytest.fixture
+def firestore(app, monkeypatch):
+    db = InMemoryFirestore(UpstreamProfile(), CallCounter())
+    monkeypatch.setitem(app.firestore_client, 'db', db)
+    return db
+
+
+@pytest.fixture
+def fake_redis(app, monkeypatch):
+    client = FakeRedis()
+    monkeypatch.setitem(app.shared_cache, 'client', client)
+    return client
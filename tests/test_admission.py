@@ -0,0 +1,144 @@
+import threading
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+
+def test_token_bucket_refills_at_rate(app):
+    bucket = app.TokenBucket(rate=10, capacity=2)
+
+    assert bucket.try_acquire() == (True, 0.0)
+    assert bucket.try_acquire() == (True, 0.0)
+    acquired, wait = bucket.try_acquire()
+    assert not acquired
+    assert 0 < wait <= 0.1
+
+    time.sleep(wait + 0.01)
+    assert bucket.try_acquire()[0]
+
+
+def test_token_bucket_release_and_timeout(app):
+    bucket = app.TokenBucket(rate=1, capacity=2)
+    assert bucket.acquire(2, timeout=0)
+    assert not bucket.acquire(1, timeout=0.1)
+
+    bucket.release(5)
+    assert bucket.tokens == 2
+    assert not bucket.try_acquire(3)[0]
+
+
+def test_client_tokens_are_refunded_when_global_bucket_refuses(app, monkeypatch):
+    monkeypatch.setattr(app, 'RATE_LIMIT_PER_IP', 1)
+    monkeypatch.setattr(app, 'RATE_LIMIT_PER_IP_BURST', 2)
+    monkeypatch.setattr(app, 'RATE_LIMIT_GLOBAL', 1)
+    monkeypatch.setattr(app, 'global_generation_bucket', app.TokenBucket(1, 1))
+
+    assert app.admit_generation('203.0.113.1') == (True, 0.0)
+    admitted, retry_after = app.admit_generation('203.0.113.1')
+    assert not admitted and retry_after > 0
+    assert app.get_client_bucket('203.0.113.1').tokens == pytest.approx(1, abs=0.1)
+
+
+@pytest.fixture
+def one_slot(app, monkeypatch):
+    monkeypatch.setattr(app, 'generation_slots', threading.BoundedSemaphore(1))
+    monkeypatch.setattr(app, 'admission_state', {'waiting': 0})
+    return app
+
+
+def test_slot_rejects_at_once_when_queue_is_full(one_slot, monkeypatch):
+    app = one_slot
+    monkeypatch.setattr(app, 'GENERATION_MAX_WAITING', 0)
+    with app.generation_slot(5) as held:
+        assert held
+        started = time.monotonic()
+        with app.generation_slot(5) as acquired:
+            assert not acquired
+        assert time.monotonic() - started < 1
+
+
+def test_slot_waits_up_to_timeout(one_slot, monkeypatch):
+    app = one_slot
+    monkeypatch.setattr(app, 'GENERATION_MAX_WAITING', 1)
+    with app.generation_slot(5):
+        with app.generation_slot(0.05) as acquired:
+            assert not acquired
+    assert app.admission_state['waiting'] == 0
+
+    # Released slots can be taken again
+    with app.generation_slot(0.05) as acquired:
+        assert acquired
+
+
+@pytest.fixture
+def client(app, firestore, monkeypatch):
+    calls = []
+
+    def fake_generate_meme(thought, location_label, **kwargs):
+        calls.append(thought)
+        return f'https://i.imgflip.test/{len(calls)}.jpg', '100000', f'doc{len(calls)}', None
+
+    monkeypatch.setattr(app, 'generate_meme', fake_generate_meme)
+    monkeypatch.setattr(app, 'RATE_LIMIT_PER_IP', 0.1)
+    monkeypatch.setattr(app, 'RATE_LIMIT_PER_IP_BURST', 1)
+    firestore.collections['memes'] = {
+        'recent': {'thought': 'Earlier', 'location': 'Paris Cafe', 'meme_url': 'https://i.imgflip.test/recent.jpg',
+                   'timestamp': datetime.now(timezone.utc)},
+    }
+    return app.app.test_client()
+
+
+def generate(client, thought):
+    return client.post('/generate_meme', json={'thought': thought, 'location': 'Paris Cafe', 'format': 'compact'})
+
+
+def test_rate_limited_request_gets_429_with_retry_after(client, firestore):
+    assert generate(client, 'first').status_code == 200
+
+    response = generate(client, 'second')
+    assert response.status_code == 429
+    assert 1 <= int(response.headers['Retry-After']) <= 10
+    assert response.json['retry_after'] == int(response.headers['Retry-After'])
+    # No feed is built yet, and rejecting doesn't build one
+    assert response.json['recent_memes'] == []
+    assert 'firestore_read' not in firestore.counter.snapshot()
+
+
+def test_rejection_uses_an_already_built_feed(client, firestore):
+    assert client.get('/get_previous_memes?format=compact').status_code == 200
+    reads = firestore.counter.snapshot()['firestore_read']
+    assert generate(client, 'first').status_code == 200
+
+    response = generate(client, 'second')
+    assert response.status_code == 429
+    assert [meme['thought'] for meme in response.json['recent_memes']] == ['Earlier']
+    assert firestore.counter.snapshot()['firestore_read'] == reads
+
+
+def test_rejection_does_not_look_up_the_location(app, client, monkeypatch):
+    lookups = []
+    monkeypatch.setattr(app, 'fetch_location_data', lambda ip_address: lookups.append(ip_address))
+    headers = {'X-Forwarded-For': '203.0.113.9'}
+    assert client.post('/generate_meme', json={'thought': 'first', 'location': 'Paris Cafe'}, headers=headers).status_code == 200
+
+    response = client.post('/generate_meme', json={'thought': 'second', 'location': 'Paris Cafe'}, headers=headers)
+    assert response.status_code == 429
+    assert lookups == []
+
+
+def test_cached_results_skip_admission(client):
+    first = generate(client, 'first')
+    assert generate(client, 'second').status_code == 429
+
+    repeat = generate(client, 'first')
+    assert repeat.status_code == 200
+    assert repeat.json['meme_url'] == first.json['meme_url']
+
+
+def test_open_circuit_gets_503(app, client, monkeypatch):
+    monkeypatch.setitem(app.circuit_state['openai'], 'opened_at', time.time())
+
+    response = generate(client, 'first')
+    assert response.status_code == 503
+    assert int(response.headers['Retry-After']) >= 1
@@ -0,0 +1,80 @@
+import json
+
+import pytest
+from upstream_stubs import CallCounter, InMemoryFirestore, UpstreamProfile
+
+
+@pytest.fixture
+def client(app, firestore, monkeypatch):
+    def fake_create_meme(thought, location_label, all_memes, memes_by_id, *args, **kwargs):
+        return f'https://i.imgflip.test/{thought}.jpg', {'id': '100000'}, 'explanation', None
+
+    monkeypatch.setattr(app, 'create_meme', fake_create_meme)
+    monkeypatch.setattr(app, 'get_template_catalog', lambda: ([], {}))
+    monkeypatch.setattr(app, 'batch_openai_budget', app.TokenBucket(100, 1000))
+    return app.app.test_client()
+
+
+def run_batch(client, count):
+    response = client.post('/generate_memes', json={'items': [{'thought': f't{i}', 'location': 'Paris Cafe'} for i in range(count)]})
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    return lines[:-1], lines[-1]
+
+
+def test_batch_is_stored_in_one_commit(client, firestore):
+    items, summary = run_batch(client, 3)
+
+    assert sorted(item['index'] for item in items) == [0, 1, 2]
+    assert summary == {'status': 'done', 'succeeded': 3, 'failed': 0, 'storage': 'saved'}
+    assert sorted(firestore.collections['memes']) == sorted(item['doc_id'] for item in items)
+    assert firestore.counter.snapshot()['firestore_commit'] == 1
+
+
+def test_failed_commit_is_reported_without_persist_worker(app, client, monkeypatch):
+    monkeypatch.setitem(app.firestore_client, 'db', InMemoryFirestore(UpstreamProfile(error_rate=1.0), CallCounter()))
+    queued = []
+    monkeypatch.setattr(app, 'queue_meme_write', lambda doc_id, meme: queued.append(doc_id))
+
+    items, summary = run_batch(client, 2)
+
+    assert all(item['status'] == 'ok' for item in items)
+    assert summary['storage'] == 'failed'
+    assert 'injected firestore_commit failure' in summary['error']
+    assert queued == []
+
+
+def test_failed_commit_is_queued_with_persist_async(app, client, monkeypatch):
+    monkeypatch.setitem(app.firestore_client, 'db', InMemoryFirestore(UpstreamProfile(error_rate=1.0), CallCounter()))
+    monkeypatch.setattr(app, 'PERSIST_ASYNC', True)
+    queued = []
+    monkeypatch.setattr(app, 'queue_meme_write', lambda doc_id, meme: queued.append(doc_id))
+
+    items, summary = run_batch(client, 2)
+
+    assert summary['storage'] == 'queued' and 'error' not in summary
+    assert sorted(queued) == sorted(item['doc_id'] for item in items)
+
+
+def test_batch_larger_than_the_per_ip_burst(app, client, monkeypatch):
+    # The single-generation defaults: 0.2 requests/s with a burst of 5
+    monkeypatch.setattr(app, 'RATE_LIMIT_PER_IP', 0.2)
+    monkeypatch.setattr(app, 'RATE_LIMIT_PER_IP_BURST', 5)
+    monkeypatch.setattr(app, 'RATE_LIMIT_GLOBAL', 5)
+    monkeypatch.setattr(app, 'global_generation_bucket', app.TokenBucket(5, 20))
+
+    items, summary = run_batch(client, 20)
+
+    assert summary['succeeded'] == 20 and summary['failed'] == 0
+    assert all(item['status'] == 'ok' for item in items)
+
+
+def test_items_over_the_batch_budget_are_turned_away(app, client, monkeypatch):
+    monkeypatch.setattr(app, 'BATCH_RATE_PER_IP', 0.01)
+    monkeypatch.setattr(app, 'BATCH_RATE_PER_IP_BURST', 3)
+    monkeypatch.setattr(app, 'BATCH_RATE_WAIT', 0)
+
+    items, summary = run_batch(client, 5)
+
+    assert summary['succeeded'] == 3 and summary['failed'] == 2
+    assert sorted(item['error'] for item in items if item['status'] == 'error') == ['Batch rate limit reached. Please retry this item later.'] * 2
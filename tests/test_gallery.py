@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def add_memes(firestore, city, region, country, count, offset):
+    memes = firestore.collections.setdefault('memes', {})
+    for i in range(count):
+        memes[f'{city.lower()}{i:03d}'] = {
+            'thought': f'{city} thought {i}', 'location': f'{city} Cafe', 'city': city, 'region': region,
+            'country': country, 'meme_url': f'https://i.imgflip.test/{city.lower()}{i}.jpg',
+            'timestamp': START + timedelta(minutes=offset + i),
+        }
+
+
+def all_pages(app, limit, **location):
+    memes, level, cursor = app.get_gallery_page(limit=limit, **location)
+    pages = [(level, memes)]
+    while cursor:
+        memes, level, cursor = app.get_gallery_page(limit=limit, cursor=cursor)
+        pages.append((level, memes))
+    return pages
+
+
+@pytest.fixture
+def seeded(app, firestore, monkeypatch):
+    # Marseille's memes are all older than the GALLERY_SIZE most recent ones, so
+    # only Firestore has them; Paris is split between the snapshot and Firestore
+    monkeypatch.setattr(app, 'GALLERY_SIZE', 6)
+    add_memes(firestore, 'Marseille', 'Provence', 'France', 5, 0)
+    add_memes(firestore, 'Paris', 'Ile-de-France', 'France', 7, 10)
+    add_memes(firestore, 'Berlin', 'Land Berlin', 'Germany', 3, 20)
+    return firestore
+
+
+def ids(pages):
+    return [meme['id'] for _, memes in pages for meme in memes]
+
+
+def test_snapshot_tier_continues_in_firestore(app, seeded):
+    pages = all_pages(app, 2, city='Paris', region='Ile-de-France', country='France')
+
+    assert {level for level, _ in pages} == {'city'}
+    # The first page comes from the snapshot (3 Paris memes), later ones from Firestore
+    assert ids(pages) == [f'paris{i:03d}' for i in reversed(range(7))]
+    assert seeded.counter.snapshot()['firestore_read'] == 1 + len(pages) - 1
+
+
+def test_tier_missing_from_snapshot_is_paged_from_firestore(app, seeded):
+    pages = all_pages(app, 2, city='Marseille', region='Provence', country='France')
+
+    assert {level for level, _ in pages} == {'city'}
+    assert ids(pages) == [f'marseille{i:03d}' for i in reversed(range(5))]
+    assert [len(memes) for _, memes in pages] == [2, 2, 1]
+
+
+def test_unknown_city_falls_back_to_snapshot_region(app, seeded):
+    memes, level, cursor = app.get_gallery_page(city='Lyon', region='Ile-de-France', country='France', limit=2)
+
+    assert level == 'region'
+    assert [meme['id'] for meme in memes] == ['paris006', 'paris005']
+    assert app.decode_gallery_cursor(cursor)[:2] == ('region', 'Ile-de-France')
+
+
+def test_global_pages_reach_every_meme(app, seeded):
+    pages = all_pages(app, 4)
+
+    assert {level for level, _ in pages} == {'global'}
+    assert len(ids(pages)) == len(set(ids(pages))) == 15
+
+
+def test_malformed_cursor_is_rejected(app, seeded):
+    with pytest.raises((ValueError, KeyError, TypeError)):
+        app.decode_gallery_cursor('not-a-cursor')
+
+
+def test_feed_page_built_during_a_write_is_not_cached(app, seeded, monkeypatch):
+    feed = app.get_gallery_feed('Paris', 'Ile-de-France', 'France')
+    new_meme = {'id': 'fresh', 'meme_url': 'https://i.imgflip.test/fresh.jpg', 'thought': 'Fresh', 'location': 'Paris Cafe',
+                'city': 'Paris', 'region': 'Ile-de-France', 'country': 'France', 'timestamp': datetime.now(timezone.utc)}
+    build_payload = app.compact_gallery_payload
+
+    def payload_with_concurrent_write(*args, **kwargs):
+        monkeypatch.setattr(app, 'compact_gallery_payload', build_payload)
+        app.add_meme_to_feeds(new_meme)
+        return build_payload(*args, **kwargs)
+
+    monkeypatch.setattr(app, 'compact_gallery_payload', payload_with_concurrent_write)
+    stale = app.get_feed_page(feed, 5)
+    assert 'fresh' not in stale['ids']
+    assert feed['pages'] == {}
+
+    assert app.get_feed_page(feed, 5)['ids'][0] == 'fresh'
@@ -0,0 +1,120 @@
+import threading
+import time
+
+import pytest
+
+
+class FakePipeline:
+    """Stands in for generate_meme; holds every run until release is set."""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.release = threading.Event()
+
+    def __call__(self, thought, location_label, **kwargs):
+        with self.lock:
+            self.calls += 1
+            run = self.calls
+        self.release.wait(5)
+        if self.error:
+            return None, None, None, self.error
+        return f'https://i.imgflip.test/{run}.jpg', '100000', f'doc{run}', None
+
+
+@pytest.fixture
+def pipeline(app, monkeypatch):
+    fake = FakePipeline()
+    monkeypatch.setattr(app, 'generate_meme', fake)
+    return fake
+
+
+def run_concurrently(app, count):
+    results = [None] * count
+
+    def worker(index):
+        results[index] = app.generate_meme_cached('Monday again', 'Paris Cafe')
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def wait_for_followers(app, count):
+    deadline = time.time() + 5
+    while app.generation_cache_stats['shared'] < count:
+        assert time.time() < deadline, 'followers never joined the running generation'
+        time.sleep(0.01)
+
+
+def test_identical_requests_share_one_run(app, pipeline):
+    threads, results = run_concurrently(app, 5)
+    wait_for_followers(app, 4)
+    pipeline.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert pipeline.calls == 1
+    assert len(set(results)) == 1 and results[0][3] is None
+    assert app.generation_cache_stats == {'hits': 0, 'misses': 1, 'shared': 4}
+    assert app.generation_inflight == {}
+
+    # Later identical requests are served from the cache
+    assert app.generate_meme_cached('  monday AGAIN ', 'paris cafe') == results[0]
+    assert pipeline.calls == 1
+    assert app.generation_cache_stats['hits'] == 1
+
+
+def test_errors_are_shared_but_not_cached(app, pipeline):
+    pipeline.error = 'Error in generate_meme: upstream down'
+    threads, results = run_concurrently(app, 3)
+    wait_for_followers(app, 2)
+    pipeline.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert pipeline.calls == 1
+    assert all(result[3] == pipeline.error for result in results)
+    key = app.generation_cache_key('Monday again', 'Paris Cafe', None)
+    assert app.generation_cache.peek_local(key) is None
+
+    # The next request tries again instead of getting the cached error
+    pipeline.error = None
+    result = app.generate_meme_cached('Monday again', 'Paris Cafe')
+    assert result[3] is None
+    assert pipeline.calls == 2
+
+
+def test_excluded_memes_are_part_of_the_key(app, pipeline):
+    pipeline.release.set()
+    first = app.generate_meme_cached('Monday again', 'Paris Cafe', excluded_memes=['1', '2'])
+    assert app.generate_meme_cached('Monday again', 'Paris Cafe', excluded_memes=['2', '1']) == first
+    assert app.generate_meme_cached('Monday again', 'Paris Cafe', excluded_memes=['3']) != first
+    assert pipeline.calls == 2
+
+
+def test_looked_up_skips_the_counted_lookup(app, pipeline):
+    pipeline.release.set()
+    assert app.get_cached_generation('Monday again', 'Paris Cafe') is None
+    app.generate_meme_cached('Monday again', 'Paris Cafe', looked_up=True)
+
+    assert app.generation_cache.stats['miss'] == 1
+
+
+def test_route_normalizes_excluded_memes(app, monkeypatch):
+    seen = []
+
+    def fake_generate_meme(thought, location_label, excluded_memes=None, **kwargs):
+        seen.append(excluded_memes)
+        return 'https://i.imgflip.test/1.jpg', '100000', 'doc1', None
+
+    monkeypatch.setattr(app, 'generate_meme', fake_generate_meme)
+    response = app.app.test_client().post('/generate_meme', json={
+        'thought': 'Monday again', 'location': 'Paris Cafe', 'format': 'compact',
+        'excluded_memes': ['181913649', 5, {'a': 1}, [2], None, True],
+    })
+
+    assert response.status_code == 200
+    assert seen == [['181913649', '5']]
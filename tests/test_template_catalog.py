@@ -0,0 +1,42 @@
+import time
+
+import pytest
+import requests
+
+
+@pytest.fixture
+def catalog(app, monkeypatch):
+    monkeypatch.setattr(app, 'template_catalog', {'memes': [], 'by_id': {}, 'index': {}, 'fetched_at': 0.0, 'refreshing': False})
+    monkeypatch.setattr(app, 'template_catalog_cache', app.TieredCache('templates', maxsize=1, ttl=60))
+    monkeypatch.setattr(app, 'TEMPLATE_CATALOG_PATH', '/nonexistent/meme_templates.json')
+    calls = []
+
+    def failing_fetch():
+        calls.append(time.time())
+        raise requests.ConnectionError('imgflip down')
+
+    monkeypatch.setattr(app, 'fetch_meme_templates', failing_fetch)
+    return calls
+
+
+def test_failed_refresh_keeps_catalog_and_backs_off(app, catalog):
+    memes = [{'name': 'Drake', 'id': '181913649', 'box_count': 2, 'url': None}]
+    app.set_template_catalog(memes, time.time() - app.TEMPLATE_CATALOG_TTL - 10)
+
+    app.refresh_template_catalog()
+
+    assert app.template_catalog['memes'] == memes
+    assert len(catalog) == 1
+    # No new refresh starts until TEMPLATE_CATALOG_RETRY has passed
+    for _ in range(5):
+        assert app.get_template_catalog()[0] == memes
+    assert len(catalog) == 1
+    assert not app.template_catalog['refreshing']
+    age = time.time() - app.template_catalog['fetched_at']
+    assert age == pytest.approx(app.TEMPLATE_CATALOG_TTL - app.TEMPLATE_CATALOG_RETRY, abs=5)
+
+
+def test_empty_catalog_is_retried(app, catalog):
+    assert app.get_template_catalog() == ([], {})
+    assert app.get_template_catalog() == ([], {})
+    assert len(catalog) == 2
@@ -0,0 +1,80 @@
+import json
+
+
+def test_values_are_shared_between_instances(app, fake_redis):
+    writer = app.TieredCache('templates', maxsize=10, ttl=60)
+    reader = app.TieredCache('templates', maxsize=10, ttl=60)
+
+    writer.set('catalog', {'memes': [1, 2]})
+    assert json.loads(fake_redis.data[app.CACHE_KEY_PREFIX + 'templates:catalog']) == {'memes': [1, 2]}
+
+    assert reader.get('catalog') == {'memes': [1, 2]}
+    # The shared hit is copied into the local tier
+    assert reader.get('catalog') == {'memes': [1, 2]}
+    assert reader.stats == {'local': 1, 'shared': 1, 'snapshot': 0, 'miss': 0}
+
+
+def test_namespaces_do_not_collide(app, fake_redis):
+    app.TieredCache('a', maxsize=10, ttl=60).set('key', 1)
+    assert app.TieredCache('b', maxsize=10, ttl=60).get('key') is None
+
+
+def test_delete_clears_both_tiers(app, fake_redis):
+    cache = app.TieredCache('templates', maxsize=10, ttl=60)
+    cache.set('catalog', [1])
+    cache.delete('catalog')
+
+    assert cache.peek_local('catalog') is None
+    assert fake_redis.data == {}
+    assert cache.get('catalog') is None
+
+
+def test_shared_tier_failure_falls_back_to_local(app, fake_redis, monkeypatch):
+    monkeypatch.setattr(app, 'CACHE_SHARED_RETRY', 60)
+    cache = app.TieredCache('generation', maxsize=10, ttl=60)
+    fake_redis.fail = True
+
+    # Errors are treated as misses and the value still lands in the local tier
+    assert cache.get('missing') is None
+    cache.set('key', 'value')
+    assert cache.get('key') == 'value'
+    assert app.shared_cache['failed_at'] is not None
+
+    # While the failure is recent the shared tier is not called at all
+    calls = fake_redis.calls
+    assert cache.get('other') is None
+    assert fake_redis.calls == calls
+
+
+def test_shared_tier_is_retried_after_backoff(app, fake_redis, monkeypatch):
+    monkeypatch.setattr(app, 'CACHE_SHARED_RETRY', 0)
+    cache = app.TieredCache('generation', maxsize=10, ttl=60)
+    fake_redis.fail = True
+    cache.set('key', 'value')
+
+    fake_redis.fail = False
+    cache.set('key', 'value')
+    assert app.TieredCache('generation', maxsize=10, ttl=60).get('key') == 'value'
+
+
+def test_snapshot_tier_is_read_last(app, fake_redis, monkeypatch, tmp_path):
+    (tmp_path / 'templates.json').write_text(json.dumps({'catalog': ['from snapshot']}))
+    monkeypatch.setattr(app, 'CACHE_SNAPSHOT_DIR', str(tmp_path))
+    cache = app.TieredCache('templates', maxsize=10, ttl=60)
+
+    assert cache.get('catalog') == ['from snapshot']
+    assert cache.get('missing') is None
+    assert cache.stats == {'local': 0, 'shared': 0, 'snapshot': 1, 'miss': 1}
+
+    fake_redis.data[app.CACHE_KEY_PREFIX + 'templates:catalog'] = json.dumps(['from shared'])
+    assert cache.get('catalog') == ['from shared']
+
+
+def test_undecodable_shared_value_is_a_miss(app, fake_redis):
+    fake_redis.data[app.CACHE_KEY_PREFIX + 'templates:catalog'] = b'\x00not json'
+    cache = app.TieredCache('templates', maxsize=10, ttl=60)
+
+    assert cache.get('catalog') is None
+    assert cache.stats['miss'] == 1
+    # The shared tier stays in use for other keys
+    assert app.shared_cache['failed_at'] is None